@@ -0,0 +1,45 @@
+import os
+import json
+import pandas as pd
+import logging
+from data_aggregator.geometry import get_centroid, get_shapefile_checksum
+
+# Centroid table is written next to the simplified geoJSON of the same shapefile
+def get_centroid_table_path(simplified_path):
+    return os.path.splitext(simplified_path)[0] + "_centroids.json"
+
+# Bump when the table layout changes so that tables written by an older version are rebuilt
+CENTROID_TABLE_VERSION = 2
+
+# Centroid of largest polygon of every feature in store. Indexed by feature index with columns long, lat.
+# Features sharing a key each get their own centroid
+def build_centroid_table(store):
+    centroids = [get_centroid(store, ind) for ind in range(len(store))]
+    return pd.DataFrame(centroids, columns = ["long", "lat"])
+
+# Centroids indexed by key property, from the first feature with each key like store.lookup
+def get_key_centroids(store, centroids):
+    keys = list(store.keys.keys())
+    key_centroids = centroids.loc[[store.keys[k] for k in keys]]
+    key_centroids.index = keys
+    return key_centroids
+
+# Read centroid table or rebuild it if the shapefile checksum changed
+def load_centroid_table(store, shp_path, table_path):
+    checksum = get_shapefile_checksum(shp_path)
+    if os.path.exists(table_path):
+        with open(table_path) as f:
+            table = json.load(f)
+        if table["checksum"] == checksum and table.get("version") == CENTROID_TABLE_VERSION and len(table["centroids"]) == len(store):
+            logging.info("Read centroids from {}".format(table_path))
+            return pd.DataFrame(table["centroids"], columns = ["long", "lat"])
+        logging.info("{} changed. Rebuilding centroids".format(shp_path))
+    centroids = build_centroid_table(store)
+    with open(table_path, "w") as fout:
+        json.dump({
+            "checksum": checksum,
+            "version": CENTROID_TABLE_VERSION,
+            "centroids": centroids.values.tolist()
+        }, fout)
+    logging.info("Wrote {} centroids to {}".format(centroids.shape[0], table_path))
+    return centroids
@@ -0,0 +1,70 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+# Long (key, date) frame of columns from metrics x locations x days values, for the days a location has data (not NaN)
+def get_long_frame(values, keys, start_date, key, columns):
+    present = ~np.isnan(values).all(axis = 0)
+    location, day = np.nonzero(present)
+    index = pd.MultiIndex.from_arrays([
+        np.asarray(keys, dtype = object)[location],
+        start_date + pd.to_timedelta(day, unit = "D")
+    ], names = [key, "date"])
+    return pd.DataFrame(dict([[i, values[n][present]] for n, i in enumerate(columns)]), index = index, columns = columns)
+
+# Daily series of every location of every level as a metrics x locations x days array. NaN where a location has no data.
+# Locations of a level are contiguous, so a level is a view of values. Saved as .npy with a .json header
+# of metrics, levels and dates and memory mapped when loaded.
+class EpiCube:
+
+    def __init__(self, values, metrics, levels, start_date):
+        self.values = values
+        self.metrics = metrics
+        self.levels = levels
+        self.start_date = pd.Timestamp(start_date)
+
+    def get_level(self, name):
+        return next(i for i in self.levels if i["name"] == name)
+
+    # metrics x locations x days of level name. A view, values are not copied
+    def get_level_values(self, name):
+        level = self.get_level(name)
+        return self.values[:, level["start"]:level["start"] + len(level["keys"])]
+
+    def save(self, path):
+        np.save(path, self.values)
+        with open(os.path.splitext(path)[0] + ".json", "w") as fout:
+            json.dump({
+                "metrics": self.metrics,
+                "levels": self.levels,
+                "start_date": self.start_date.strftime("%Y-%m-%d"),
+                "shape": list(self.values.shape),
+                "dtype": self.values.dtype.name
+            }, fout)
+        logging.info("Wrote {} cube of {} metrics x {} locations x {} days to {}".format(self.values.dtype.name, *self.values.shape, path))
+
+# Memory maps cube saved at path
+def load_epi_cube(path):
+    with open(os.path.splitext(path)[0] + ".json") as f:
+        header = json.load(f)
+    return EpiCube(np.load(path, mmap_mode = "r"), header["metrics"], header["levels"], header["start_date"])
+
+# Cube of rollup sums of every level in levels, {name: key}. Counts are float64 because float32 is only exact up to 2 ** 24
+def build_count_cube(rollup, levels, dtype = np.float64):
+    cube_levels = []
+    start = 0
+    for name, key in levels.items():
+        cube_levels.append({
+            "name": name,
+            "key": key,
+            "start": start,
+            "keys": [str(i) for i in rollup.keys[key]]
+        })
+        start += len(rollup.keys[key])
+    # Every level is written into its slice of one array, without concatenating copies
+    values = np.empty((len(rollup.columns), start, rollup.ndays), dtype = dtype)
+    for level in cube_levels:
+        values[:, level["start"]:level["start"] + len(level["keys"])] = rollup.dense(level["key"])
+    return EpiCube(values, rollup.columns, cube_levels, rollup.start_date)
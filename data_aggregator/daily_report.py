@@ -2,68 +2,137 @@ import pandas as pd
 import numpy as np
 from datetime import datetime as dt
 import os
+import multiprocessing
 import logging
+from data_aggregator.geometry import get_centroid
+
+# Columns of each JHU daily report schema mapped to the names used downstream
+_era1_columns = {
+    "Province/State": "Province_State",
+    "Country/Region": "Country_Region",
+    "Last Update": "Last_Update",
+    "Confirmed": "Confirmed",
+    "Deaths": "Deaths",
+    "Recovered": "Recovered"
+}
+_era2_columns = dict(_era1_columns, **{
+    "Latitude": "Lat",
+    "Longitude": "Long"
+})
+_era3_columns = {
+    "FIPS": "FIPS",
+    "Admin2": "Admin2",
+    "Province_State": "Province_State",
+    "Country_Region": "Country_Region",
+    "Last_Update": "Last_Update",
+    "Lat": "Lat",
+    "Long_": "Long",
+    "Confirmed": "Confirmed",
+    "Deaths": "Deaths",
+    "Recovered": "Recovered",
+    "Active": "Active",
+    "Combined_Key": "Combined_Key"
+}
+_era4_columns = dict(_era3_columns, **{
+    "Incidence_Rate": "Incidence_Rate",
+    "Case-Fatality_Ratio": "Case-Fatality_Ratio"
+})
+_era5_columns = dict(_era3_columns, **{
+    "Incident_Rate": "Incident_Rate",
+    "Case_Fatality_Ratio": "Case_Fatality_Ratio"
+})
+daily_report_schemas = [
+    ["jan_2020", _era1_columns],      # Until 02-29-2020
+    ["mar_2020", _era2_columns],      # 03-01-2020 to 03-21-2020, adds Latitude, Longitude
+    ["admin2", _era3_columns],        # 03-22-2020, adds FIPS, Admin2
+    ["incidence", _era4_columns],     # Adds incidence rate and case fatality ratio
+    ["incident", _era5_columns]       # Same with renamed rate columns
+]
+
+_string_columns = ["FIPS", "Admin2", "Province_State", "Country_Region", "Last_Update", "Combined_Key"]
+
+# Schema name and column map of report from its header. Unknown headers fall back to replacing "/" and " " in names.
+def get_daily_report_schema(path):
+    with open(path, encoding = "utf-8-sig") as f:
+        header = pd.read_csv(f, nrows = 0).columns
+    header = [i.strip() for i in header]
+    for name, columns in daily_report_schemas:
+        if set(header) == set(columns.keys()):
+            return name, columns
+    logging.warning("Unknown daily report schema in {}: {}".format(os.path.basename(path), ",".join(header)))
+    columns = dict([[i, i.replace("/", "_").replace(" ", "_")] for i in header])
+    columns = dict([[k, "Lat" if v in ["Lat", "Latitude"] else "Long" if v in ["Long_", "Longitude"] else v] for k, v in columns.items()])
+    return None, columns
+
+# Strips each distinct string once instead of every cell
+def strip_strings(col):
+    codes, uniques = pd.factorize(col)
+    stripped = np.append(pd.Index(uniques).str.strip().values.astype(object), np.nan)
+    return pd.Series(stripped[codes], index = col.index)
 
 def read_daily_report(path):
-    _dtypes = {
-        "Provine/State": str,
-        "Country/Region": str,
-        "Laste Update": str,
-        "Confirmed": float,
-        "Deaths": float,
-        "Recovered": float,
-        "Lat": float,
-        "Long_":float,
-        "FIPS": str,
-        "Admin2": str,
-        "Province_State": str,
-        "Country_Region": str,
-        "Last_Update": str,
-        "Active": float,
-        "Combined_Key": str,
-        "Incidence_Rate": float,
-        "Case-Fatality_Ratio": float
-    }
-    df = pd.read_csv(path, dtype = _dtypes)
-    df.columns = [i.replace("/", "_").replace(" ", "_").strip() for i in df.columns]
-    df.columns = [i if i not in ["Lat", "Latitude"] else "Lat" for i in df.columns]
-    df.columns = [i if i not in ["Long_", "Longitude"] else "Long"for i in df.columns]
+    schema, columns = get_daily_report_schema(path)
+    with open(path, encoding = "utf-8-sig") as f:
+        df = pd.read_csv(f, dtype = dict([[i, str if columns[i] in _string_columns else float] for i in columns if schema != None or columns[i] in _string_columns]))
+    df = df.rename(columns = dict([[i, columns[i.strip()]] for i in df.columns]))
     df["date"] = dt.strptime(os.path.basename(path)[:-4], "%m-%d-%Y")
     if "Lat" in df.columns:
-        df["Lat"] = df["Lat"].apply(lambda x: np.nan if x == 0 else x)
-        df["Long"] = df["Long"].apply(lambda x: np.nan if x == 0 else x)
-    df = df.apply(lambda x: x.str.strip() if x.dtype == 'O' else x)
+        df["Lat"] = df["Lat"].astype(float).replace(0, np.nan)
+        df["Long"] = df["Long"].astype(float).replace(0, np.nan)
+    for i in df.columns:
+        if i in _string_columns or df[i].dtype == "O":
+            df[i] = strip_strings(df[i])
     return df
 
-# Add lat lng from countries already set
+# Parses every report in path on nprocess workers and concatenates them. String columns are returned as categoricals.
+# Reports parsed on a previous run are reused from report_cache when given.
+def read_daily_reports(path, nprocess, report_cache = None):
+    if report_cache != None:
+        daily_reports = report_cache.read_all(path, read_daily_report, nprocess)
+    else:
+        paths = [os.path.join(path, i) for i in sorted(os.listdir(path)) if i[-4:] == ".csv"]
+        with multiprocessing.Pool(processes = nprocess) as pool:
+            daily_reports = pool.map(read_daily_report, paths)
+    daily_df = pd.concat(daily_reports, ignore_index = True, sort = False)
+    for i in _string_columns:
+        if i in daily_df.columns:
+            daily_df[i] = daily_df[i].astype("category")
+    return daily_df
+
+# Add lat lng from countries already set. Rows of key missing Lat or Long get the mean of rows with both set.
 def add_lat_long(daily_df, key, key_null = None):
-    mean_lat_long = None
+    known = ~daily_df["Lat"].isna() & ~daily_df["Long"].isna()
     if isinstance(key_null, list):
-        mean_lat_long = daily_df[~daily_df["Lat"].isna() & ~daily_df["Long"].isna() & daily_df[key_null[0]].isna() & daily_df[key_null[1]].isna()].groupby(key).mean()
-    elif key_null == None:
-        mean_lat_long = daily_df[~daily_df["Lat"].isna() & ~daily_df["Long"].isna()].groupby(key).mean()
-    else:
-        mean_lat_long = daily_df[~daily_df["Lat"].isna() & ~daily_df["Long"].isna() & daily_df[key_null].isna()].groupby(key).mean()
-    for ind, row in daily_df.iterrows():
-        if pd.isna(row[key]) or row[key] == None:
-            continue
-        if not pd.isna(row["Lat"]) and not pd.isna(row["Long"]):
-            continue
-        if row[key] not in mean_lat_long.index:
-            logging.info("Lat, Long not found for {}: {}".format(key, row[key]))
-            continue
-        daily_df.loc[ind, "Lat"] = mean_lat_long.loc[row[key]]["Lat"]
-        daily_df.loc[ind, "Long"] = mean_lat_long.loc[row[key]]["Long"]
-
-
-def get_us_admn2_feat(fips, shp):
-    feats = [i for i in shp if str(i["properties"]["STATEFP"]) + str(i["properties"]["COUNTYF"]) == fips]
-    if len(feats) == 0:
+        known = known & daily_df[key_null[0]].isna() & daily_df[key_null[1]].isna()
+    elif key_null != None:
+        known = known & daily_df[key_null].isna()
+    mean_lat_long = daily_df.loc[known, [key, "Lat", "Long"]].groupby(key, observed = True).mean()
+    missing = ~daily_df[key].isna() & (daily_df["Lat"].isna() | daily_df["Long"].isna())
+    keys = daily_df.loc[missing, key].astype(object)
+    found = keys.isin(mean_lat_long.index)
+    for k, n in keys[~found].value_counts().items():
+        logging.info("Lat, Long not found for {}: {} ({} rows)".format(key, k, n))
+    keys = keys[found]
+    daily_df.loc[keys.index, "Lat"] = keys.map(mean_lat_long["Lat"]).astype(float)
+    daily_df.loc[keys.index, "Long"] = keys.map(mean_lat_long["Long"]).astype(float)
+
+
+def get_us_admn2_feat(fips, store):
+    ind = store.lookup(fips)
+    if ind == None:
         logging.info("NYT Data doesn't have matching for county with fips {}".format(fips))
-        return None
-    return feats[0]
+    return ind
+
+# Sets Lat and Long of rows in mask to the most frequent value of their group. Ties go to the smallest value like Series.mode.
+# Only rows in mask are used when given. Rows with a missing key are left unchanged.
+def set_modal_lat_long(daily_df, keys, mask = None):
+    sub = (daily_df if mask is None else daily_df.loc[mask])[keys + ["Lat", "Long"]].dropna(subset = keys)
+    for col in ["Lat", "Long"]:
+        counts = sub.groupby(keys + [col], observed = True).size().rename("n").reset_index()
+        modes = counts.sort_values(["n", col], ascending = [False, True]).drop_duplicates(keys)
+        daily_df.loc[sub.index, col] = sub[keys].merge(modes[keys + [col]], on = keys, how = "left")[col].values
 
-def fix_daily_reports(daily_df, admn0_shp)
+def fix_daily_reports(daily_df, admn0_store):
     # Correct wrong lat_lng longs. Check if name matches shapefile nad populate list below.
     wrong_lat_long = ["Belize", "Malaysia"]
     for cntry in wrong_lat_long:
@@ -71,8 +140,8 @@ def fix_daily_reports(daily_df, admn0_shp)
         n_admin_lower = daily_df[daily_df["Country_Region"] == cntry][["Province_State"]].dropna().shape[0] + daily_df[daily_df["Country_Region"] == cntry][["Admin2"]].dropna().shape[0]
         if n_admin_lower > 0:
             logging.warning("{} has admin 1 or 2. Verify if centroid of country is correct lat long!")
-        feat = [i for i in admn0_shp if i["properties"]["NAME"] == cntry][0]
-        centroid = get_centroid(feat["geometry"])
+        ind = next(i for i in range(len(admn0_store)) if admn0_store.properties[i]["NAME"] == cntry)
+        centroid = get_centroid(admn0_store, ind)
         daily_df.loc[daily_df["Country_Region"] == cntry, "Long"] = centroid[0]
         daily_df.loc[daily_df["Country_Region"] == cntry, "Lat"] = centroid[1]
 
@@ -94,25 +163,17 @@ def fix_daily_reports(daily_df, admn0_shp)
     # Remove nan lat long : cruises mostly
     unknown = daily_df[daily_df["Lat"].isna()]
     logging.warning("Unknown lat longs for {} rows".format(unknown.shape[0]))
-    unknown_confirmed = unknown.sort_values("date", ascending = False).groupby("Province_State").head(1)["Confirmed"].sum()
+    unknown_confirmed = unknown.sort_values("date", ascending = False).groupby("Province_State", observed = True).head(1)["Confirmed"].sum()
     logging.warning("Unaccounted cases due to missing lat long: {}".format(unknown_confirmed))
     logging.info("\n".join(daily_df[daily_df["Lat"].isna()]["Country_Region"].unique()))
     daily_df = daily_df[~daily_df["Lat"].isna()]
 
     # Set lat long to the most frequent used values. To deal with cases like French Polynesia
-    for i, grp in daily_df[daily_df["Province_State"].isna() & daily_df["Admin2"].isna()].groupby("Country_Region"):
-        daily_df.loc[(daily_df["Country_Region"] == i) & daily_df["Province_State"].isna() & daily_df["Admin2"].isna(), "Lat"] = grp["Lat"].dropna().mode().values[0]
-        daily_df.loc[(daily_df["Country_Region"] == i) & daily_df["Province_State"].isna() & daily_df["Admin2"].isna(), "Long"] = grp["Long"].dropna().mode().values[0]
-
-    for i, grp in daily_df[daily_df["Admin2"].isna()].groupby(["Country_Region", "Province_State"]):
-        daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & daily_df["Admin2"].isna(), "Lat"] = grp["Lat"].dropna().mode().values[0]
-        daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & daily_df["Admin2"].isna(), "Long"] = grp["Long"].dropna().mode().values[0]
-
-    for i, grp in daily_df.groupby(["Country_Region", "Province_State", "Admin2"]):
-        daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & (daily_df["Admin2"] == i[2]), "Lat"] = grp["Lat"].dropna().mode().values[0]
-        daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & (daily_df["Admin2"] == i[2]), "Long"] = grp["Long"].dropna().mode().values[0]
+    set_modal_lat_long(daily_df, ["Country_Region"], daily_df["Province_State"].isna() & daily_df["Admin2"].isna())
+    set_modal_lat_long(daily_df, ["Country_Region", "Province_State"], daily_df["Admin2"].isna())
+    set_modal_lat_long(daily_df, ["Country_Region", "Province_State", "Admin2"])
 
     # Round Lat Long to 4 decimal places
     daily_df["Lat"] = daily_df["Lat"].round(6)
     daily_df["Long"] = daily_df["Long"].round(6)
-
+    return daily_df
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+from data_aggregator.geo_cache import quantize_coords
+
+# Columns of each dimension table computed from feature properties
+country_attrs = {
+    "computed_country_name": lambda x: x["NAME"],
+    "computed_country_pop": lambda x: x["POP_EST"],
+    "computed_country_iso3": lambda x: x["ADM0_A3"],
+    "computed_region_wb": lambda x: x["REGION_WB"]
+}
+
+state_attrs = {
+    "computed_state_name": lambda x: x["name"],
+    "computed_state_iso3": lambda x: x["i_3166_"],
+    "computed_state_pop": lambda x: x["POPESTI"]
+}
+
+county_attrs = {
+    "computed_county_name": lambda x: x["NAMELSA"],
+    "computed_county_iso3": lambda x: x["STATEFP"] + x["COUNTYF"],
+    "computed_county_pop": lambda x: x["POPESTI"]
+}
+
+metro_attrs = {
+    "computed_metro_cbsa": lambda x: x["CBSAFP"],
+    "computed_metro_name": lambda x: x["NAME"],
+    "computed_metro_pop": lambda x: x["POPESTI"]
+}
+
+# One row per feature of store, indexed by feature index. Centroid of the same feature is added as <prefix>_long, <prefix>_lat,
+# so features sharing a key keep their own centroid
+def build_dimension_table(store, attrs, centroids, prefix):
+    dim = pd.DataFrame([dict([[k, get_attr(props)] for k, get_attr in attrs.items()]) for props in store.properties], columns = list(attrs.keys()))
+    dim[prefix + "_long"] = centroids["long"].reindex(dim.index).values
+    dim[prefix + "_lat"] = centroids["lat"].reindex(dim.index).values
+    return dim
+
+# Feature index of every value in keys from dict feats. -1 where there is no feature
+def get_feats(keys, feats):
+    return keys.astype(object).map(feats).fillna(-1).astype(np.int64).values
+
+# Feature index of Lat, Long of every row of df from geo join feats. Each distinct coordinate is looked up once
+def get_coords_feats(df, feats):
+    coords = df[["Lat", "Long"]].drop_duplicates()
+    coords["feat"] = [feats.get(quantize_coords(lat, lng), -1) if not (pd.isna(lat) or pd.isna(lng)) else -1 for lat, lng in zip(coords["Lat"], coords["Long"])]
+    return df[["Lat", "Long"]].merge(coords, on = ["Lat", "Long"], how = "left")["feat"].values
+
+# Rows of dim for feats, indexed like the rows of daily_df they belong to. Rows without a feature are NaN
+def join_dimension(dim, index, feats, columns = None):
+    tmp = dim.reindex(feats)
+    tmp.index = index
+    return tmp if columns == None else tmp[columns]
+
+# Writes the columns of tmp, from join_dimension, to the rows of df it is indexed by in one assignment.
+# Columns df does not have yet are added empty with the dtype of tmp first, so the assignment does not enlarge df
+def attach_dimension(df, tmp):
+    for i in tmp.columns:
+        if i not in df.columns:
+            df[i] = pd.Series(index = df.index, dtype = tmp[i].dtype)
+    df.loc[tmp.index, list(tmp.columns)] = tmp.values
@@ -0,0 +1,39 @@
+import logging
+import numpy as np
+import pandas as pd
+
+# Count and population columns stored as int32. Smaller types could overflow when groups are summed
+count_columns = ["Confirmed", "Deaths", "Recovered", "Active"]
+population_columns = ["computed_country_pop", "computed_state_pop", "computed_county_pop", "computed_metro_pop"]
+
+def get_memory_usage(df):
+    return df.memory_usage(deep = True).sum()
+
+def format_bytes(n):
+    return "{:.1f} MB".format(n / 2 ** 20)
+
+def log_memory(df, stage):
+    logging.info("daily_df after {}: {} rows, {}".format(stage, df.shape[0], format_bytes(get_memory_usage(df))))
+
+# Integer valued columns without NaN that fit become int32. Columns with NaN, fractions or larger values are left as they are
+def downcast_integers(col):
+    if col.isna().any() or not np.array_equal(np.floor(col.values), col.values):
+        return col
+    info = np.iinfo(np.int32)
+    if col.shape[0] > 0 and (col.min() < info.min or col.max() > info.max):
+        return col
+    return col.astype(np.int32)
+
+# Converts repeated strings of df to categoricals and downcasts counts and populations. Logs memory before and after.
+# Columns in exclude are left as strings, for stages that still write new values into them.
+def compact_frame(df, stage, exclude = [], max_category_ratio = 0.5):
+    before = get_memory_usage(df)
+    for i in df.columns:
+        if i in exclude:
+            continue
+        if i in count_columns + population_columns:
+            df[i] = downcast_integers(pd.to_numeric(df[i]))
+        elif df[i].dtype == "O" and df[i].nunique() <= max_category_ratio * df.shape[0]:
+            df[i] = df[i].astype("category")
+    logging.info("daily_df after {}: {} rows, {} -> {}".format(stage, df.shape[0], format_bytes(before), format_bytes(get_memory_usage(df))))
+    return df
@@ -0,0 +1,56 @@
+import os
+import json
+import logging
+from data_aggregator.geometry import get_shapefile_checksum
+
+# Integer coordinates so that lookups don't depend on float rounding. Lat, Long are rounded to 6 decimals.
+def quantize_coords(lat, lng, precision = 6):
+    return int(round(lat * 10 ** precision)), int(round(lng * 10 ** precision))
+
+# Geo joins of previous runs for one shapefile. Maps quantized (lat, long) to index of matched feature.
+# Feature indices are stable for a given shapefile so the cache is dropped when its checksum changes.
+class GeoJoinCache:
+
+    def __init__(self, path, shp_path, precision = 6):
+        self.path = path
+        self.shp_path = shp_path
+        self.precision = precision
+        self.checksum = get_shapefile_checksum(shp_path)
+        self.feats = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                cache = json.load(f)
+            if cache["checksum"] == self.checksum and cache["precision"] == precision:
+                self.feats = dict([[tuple(int(i) for i in k.split(",")), v] for k, v in cache["feats"].items()])
+            else:
+                logging.info("{} changed. Discarding geo join cache {}".format(shp_path, path))
+
+    # Returns dict of quantized coords to feature index. Only coords not seen before reach the spatial index.
+    # get_index builds the index and is only called on the first miss, so geometries are not decoded when every coord is cached.
+    def join(self, coords_list, get_index):
+        index = None
+        hits = 0
+        misses = 0
+        feats = {}
+        for lat, lng in coords_list:
+            key = quantize_coords(lat, lng, self.precision)
+            if key in feats:
+                continue
+            if key in self.feats:
+                hits += 1
+            else:
+                misses += 1
+                if index == None:
+                    index = get_index()
+                self.feats[key] = index.get_closest_polygon((lat, lng))
+            feats[key] = self.feats[key]
+        logging.info("Geo join cache for {}: {} hits, {} misses".format(os.path.basename(self.shp_path), hits, misses))
+        return feats
+
+    def save(self):
+        with open(self.path, "w") as fout:
+            json.dump({
+                "checksum": self.checksum,
+                "precision": self.precision,
+                "feats": dict([["{},{}".format(*k), v] for k, v in self.feats.items()])
+            }, fout)
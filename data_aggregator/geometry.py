@@ -1,24 +1,124 @@
 from shapely.geometry import shape, Point, LinearRing
+from shapely.prepared import prep
+import hashlib
+import os
+
+# Key property of features in each shapefile
+get_admn0_key = lambda x: x["ADM0_A3"]
+get_admn1_key = lambda x: x["i_3166_"] if "i_3166_" in x else x["iso_3166_2"]
+get_admn2_key = lambda x: str(x["STATEFP"]) + str(x["COUNTYF"])
+get_metro_key = lambda x: x["CBSAFP"]
+
+# Map territory fips to adm0_a3 code
+fips_iso3 = {
+    "VIR": "52",
+    "GUM": "66",
+    "MNP": "69",
+    "VIR": "78",
+    "PRI": "72",
+    "ASM": "60"
+}
+
+# State fips of US states and territories in admin1 shapefile
+get_state_fips_key = lambda x: fips_iso3[x["adm0_a3"]] if x["adm0_a3"] in fips_iso3 else x["fips"][2:] if x["adm0_a3"] == "USA" and x["fips"] != None else None
+
+# Maps key property to first feature with it in one pass over shapefile
+def index_features(shp, get_key):
+    index = {}
+    for feat in shp:
+        key = get_key(feat["properties"])
+        if key != None:
+            index.setdefault(key, feat)
+    return index
+
+# Features of an opened shapefile or CachedShapefile. Features are referred to by their index.
+# Lookups by get_key and by every named key in other_keys are built in the same pass.
+# Geometries are converted to shapely and prepared once, when first accessed.
+class GeometryStore:
+
+    def __init__(self, shp, get_key = None, **other_keys):
+        self.properties = []
+        self.raw_geometries = []
+        self.keys = {}
+        self.indexes = dict([[name, {}] for name in other_keys])
+        # Cached shapefiles decode WKB on demand. Fiona features keep their GeoJSON until parsed
+        self.cached = shp if hasattr(shp, "get_geometry") else None
+        for feat in (shp.properties if self.cached != None else shp):
+            props = dict(feat) if self.cached != None else dict(feat["properties"])
+            ind = len(self.properties)
+            self.properties.append(props)
+            if self.cached == None:
+                self.raw_geometries.append(feat["geometry"])
+            if get_key != None:
+                self.keys.setdefault(get_key(props), ind)
+            for name, get_other_key in other_keys.items():
+                key = get_other_key(props)
+                if key != None:
+                    self.indexes[name].setdefault(key, ind)
+        self.geometries = [None] * len(self.properties)
+        self.prepared = [None] * len(self.properties)
+
+    def __len__(self):
+        return len(self.properties)
+
+    # Index of first feature with key property or None. name selects one of other_keys
+    def lookup(self, key, name = None):
+        return self.keys.get(key) if name == None else self.indexes[name].get(key)
+
+    def geometry(self, ind):
+        if self.geometries[ind] is None:
+            if self.cached != None:
+                self.geometries[ind] = self.cached.get_geometry(ind)
+            else:
+                self.geometries[ind] = shape(self.raw_geometries[ind])
+                self.raw_geometries[ind] = None
+        return self.geometries[ind]
+
+    def prepared_geometry(self, ind):
+        if self.prepared[ind] is None:
+            self.prepared[ind] = prep(self.geometry(ind))
+        return self.prepared[ind]
+
+# Maps joined child features to the parent feature named by parent_key in their properties.
+# Children whose parent is missing from parent_store are left out.
+def get_parent_feats(feats, child_store, parent_store, parent_key = "adm0_a3"):
+    parent_feats = {}
+    for coords, ind in feats.items():
+        parent_ind = parent_store.lookup(child_store.properties[ind][parent_key])
+        if parent_ind != None:
+            parent_feats[coords] = parent_ind
+    return parent_feats
+
+# md5 of a shapefile and its sidecar files. Tables derived from a shapefile are invalidated when it changes
+def get_shapefile_checksum(path):
+    base = os.path.splitext(path)[0]
+    paths = [base + ext for ext in [".shp", ".shx", ".dbf"] if os.path.exists(base + ext)]
+    md5 = hashlib.md5()
+    for p in paths if len(paths) > 0 else [path]:
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                md5.update(chunk)
+    return md5.hexdigest()
 
 # Return centroid of polygon or largest polygon in set
-def get_centroid(geom):
+def get_centroid(store, ind):
     p = []
-    if geom["type"] == "MultiPolygon":
-        polys = shape(geom)
+    geom = store.geometry(ind)
+    if geom.geom_type == "MultiPolygon":
         max_area = -1
         max_poly = None
-        for poly in polys:
+        for poly in geom.geoms:
             if poly.area > max_area:
                 max_poly = poly
                 max_area = poly.area
         p = max_poly.centroid.xy
     else:
-        p = shape(geom).centroid.xy
+        p = geom.centroid.xy
     return p[0][0], p[1][0]
 
-def check_point_in_polygon(geom, lat ,lng):
+def check_point_in_polygon(store, ind, lat ,lng):
     p = Point(lng, lat)
-    if p.within(shape(geom)):
+    if store.prepared_geometry(ind).contains(p):
         return True
     return False
 
@@ -31,26 +131,23 @@ def get_distance_from_polygon(poly, lat, lng):
     dist = ((lng - closest_point[0]) ** 2 + (lat - closest_point[1])**2) ** 0.5
     return dist
 
-# Returns feat that contains point or closest feat
-def get_closest_polygon(coords, shp):
+# Closest exterior ring of any polygon in feature
+def get_distance_from_feature(store, ind, lat, lng):
+    geom = store.geometry(ind)
+    polys = geom.geoms if geom.geom_type == "MultiPolygon" else [geom]
+    return min(get_distance_from_polygon(poly, lat, lng) for poly in polys)
+
+# Returns index of feat that contains point or closest feat
+def get_closest_polygon(coords, store):
     lat, lng = coords
-    closest_feat = None
+    closest_ind = None
     min_dist = float("Inf")
-    for feat in shp:
-        if check_point_in_polygon(feat["geometry"], lat, lng):
-            return feat
-    for feat in shp:
-        if feat["geometry"]["type"] == "MultiPolygon":
-            dists = []
-            polys = shape(feat["geometry"])
-            for poly in polys:
-                d = get_distance_from_polygon(poly, lat, lng)
-                dists.append(d)
-            dist = min(dists)
-        else:
-            dist = get_distance_from_polygon(shape(feat["geometry"]), lat, lng)
+    for ind in range(len(store)):
+        if check_point_in_polygon(store, ind, lat, lng):
+            return ind
+    for ind in range(len(store)):
+        dist = get_distance_from_feature(store, ind, lat, lng)
         if dist < min_dist:
-            closest_feat = feat
+            closest_ind = ind
             min_dist = dist
-    return closest_feat
-
+    return closest_ind
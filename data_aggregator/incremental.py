@@ -0,0 +1,202 @@
+import os
+import pickle
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from data_aggregator.stats import (stat_api_keys, compute_level_stats, compute_location_stats, generate_level_items, update_location_stats,
+                                   get_days_since_thresholds)
+
+# Bump when generated items or the state change so that items of an older version are not carried forward
+ITEMS_VERSION = 2
+
+# Days at the end of a run whose counts are kept for every location. A revision within them only regenerates the items of
+# the days it affects. A revision before them is found from a hash of the older days and regenerates every item of the location
+TAIL_DAYS = 21
+
+# Stats that are the same on every date of a location. A new day changes them for every item of the location,
+# so carried items are patched instead of generated again
+location_stat_columns = [api_key + "_firstDate" for api_key in stat_api_keys] + [api_key + "_newToday" for api_key in stat_api_keys] + ["first_dead-first_confirmed"]
+
+def get_item_state_path(path, name):
+    return os.path.join(path, "items_{}.pkl".format(name))
+
+def load_item_state(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    return state if state["version"] == ITEMS_VERSION else None
+
+def save_item_state(path, state):
+    state["version"] = ITEMS_VERSION
+    with open(path, "wb") as fout:
+        pickle.dump(state, fout, protocol = pickle.HIGHEST_PROTOCOL)
+
+# Copy of frame with object keys, so that frames with categorical keys of different categories can be aligned
+def with_object_keys(frame):
+    frame = frame.copy()
+    if isinstance(frame.index, pd.MultiIndex):
+        frame.index = pd.MultiIndex.from_arrays([np.asarray(frame.index.get_level_values(0), dtype = object), frame.index.get_level_values(1)], names = frame.index.names)
+    else:
+        frame.index = pd.Index(np.asarray(frame.index, dtype = object), name = frame.index.name)
+    return frame
+
+# Hash of counts, NaN of days without data included, so that the counts of a run do not have to be kept to compare with it
+def get_counts_hash(values):
+    return hashlib.sha1(np.ascontiguousarray(values, dtype = np.float64).tobytes()).hexdigest()
+
+# Hash of a whole context entry
+def get_context_hash(value):
+    return hashlib.sha1(pd.util.hash_pandas_object(value).values.tobytes() + str(list(getattr(value, "columns", []))).encode()).hexdigest()
+
+# Hash of the row of frame of every value of index. 0 where frame has no row
+def get_row_hashes(frame, index):
+    hashes = pd.Series(pd.util.hash_pandas_object(frame, index = False).values, index = with_object_keys(frame).index)
+    return hashes[~hashes.index.duplicated()].reindex(index, fill_value = 0).values
+
+# (key, date) of every present day of every location, in the order of the level's rows
+def get_row_index(keys, present, start_date):
+    location, day = np.nonzero(present)
+    return pd.MultiIndex.from_arrays([np.asarray(keys, dtype = object)[location], start_date + pd.to_timedelta(day, unit = "D")])
+
+def get_location_stat_values(location_stats, n):
+    return dict([[k, location_stats[k][n]] for k in location_stat_columns])
+
+def get_crossings(location_stats, n):
+    return [[float(day[n]), float(offset[n])] for day, offset in location_stats["crossings"].values()]
+
+def is_same_value(a, b):
+    return a == b if not (isinstance(a, float) and isinstance(b, float)) else (a == b or (np.isnan(a) and np.isnan(b)))
+
+def is_same_item(a, b):
+    return a.keys() == b.keys() and all(is_same_value(a[k], b[k]) for k in a)
+
+def is_same_crossings(a, b):
+    return all(is_same_value(x, y) for i, j in zip(a, b) for x, y in zip(i, j))
+
+# State of the items of a level for the next run. For every location: a hash of its counts before the last TAIL_DAYS days of cube,
+# the counts of those days, its location wide stats and daysSince crossings, hashes of its rows of row_context and location_context
+# and its items with the day of each. Other context entries are kept as hashes
+def build_item_state(cube, level, context, items, days_since_thresholds = None, row_context = [], location_context = []):
+    thresholds = days_since_thresholds if days_since_thresholds != None else get_days_since_thresholds()
+    keys = cube.get_level(level)["keys"]
+    values = cube.get_level_values(level)
+    present = ~np.isnan(values).all(axis = 0)
+    ndays = present.shape[1]
+    tail_start = max(ndays - TAIL_DAYS, 0)
+    location_stats = compute_location_stats(values, present, cube.start_date, cube.metrics, thresholds)
+    row_hashes = dict([[k, get_row_hashes(context[k], get_row_index(keys, present, cube.start_date))] for k in row_context])
+    location_hashes = dict([[k, get_row_hashes(context[k], pd.Index(keys, dtype = object))] for k in location_context])
+    locations = {}
+    start = 0
+    for n, key in enumerate(keys):
+        days = np.nonzero(present[n])[0]
+        locations[key] = {
+            "prefix": get_counts_hash(values[:, n, :tail_start]),
+            "tail": np.array(values[:, n, tail_start:]),
+            "location_stats": get_location_stat_values(location_stats, n),
+            "crossings": get_crossings(location_stats, n),
+            "row_context": dict([[k, v[start:start + days.shape[0]]] for k, v in row_hashes.items()]),
+            "location_context": dict([[k, v[n]] for k, v in location_hashes.items()]),
+            "days": days,
+            "items": items[start:start + days.shape[0]]
+        }
+        start += days.shape[0]
+    return {
+        "start_date": cube.start_date,
+        "ndays": ndays,
+        "tail_start": tail_start,
+        "metrics": list(cube.metrics),
+        "thresholds": thresholds,
+        "context": dict([[k, get_context_hash(v)] for k, v in context.items() if k not in row_context + location_context]),
+        "locations": locations
+    }
+
+# First day of location n whose items can differ from the items of the previous run in prev. Every day if its counts before
+# the kept days, its daysSince crossings or its location_context rows changed. Otherwise 3 days before the first changed or
+# added day, since rolling means of days before a change average it, and the previous last day when days were added after it
+def get_first_changed_day(state, prev, values, present, n, row_hashes, location_hashes, location_stats):
+    if prev == None or get_counts_hash(values[:, n, :state["tail_start"]]) != prev["prefix"]:
+        return 0
+    if not is_same_crossings(get_crossings(location_stats, n), prev["crossings"]):
+        return 0
+    if any(v[n] != prev["location_context"][k] for k, v in location_hashes.items()):
+        return 0
+    ndays = present.shape[1]
+    tail = values[:, n, state["tail_start"]:state["ndays"]]
+    changed = np.nonzero(~((tail == prev["tail"]) | (np.isnan(tail) & np.isnan(prev["tail"]))).all(axis = 0))[0]
+    first_day = ndays
+    if present[n, state["ndays"]:].any():
+        first_day = min(state["ndays"] - 3, prev["days"][-1]) if prev["days"].shape[0] > 0 else 0
+    if changed.shape[0] > 0:
+        first_day = min(first_day, state["tail_start"] + changed[0] - 3)
+    # Items of days whose row_context rows changed are generated again as well
+    carried = np.searchsorted(prev["days"], first_day)
+    for k, v in row_hashes.items():
+        row_changed = np.nonzero(v[n][:carried] != prev["row_context"][k][:carried])[0]
+        if row_changed.shape[0] > 0:
+            first_day = min(first_day, prev["days"][row_changed[0]])
+    return max(first_day, 0)
+
+# Items of level of cube from the items of the previous run in state. Only the items of days from the first changed day of every
+# location on are generated, from stats of those days. Items before it are carried forward and their location wide stats are
+# updated. Returns None, to generate every item, when the state does not match the cube or context entries other than
+# row_context (frames indexed by (key, date)) and location_context (indexed by key) changed
+def update_level_items(generate_item, cube, level, context, nprocess, name, chunksize, state, days_since_thresholds = None, row_context = [], location_context = []):
+    thresholds = days_since_thresholds if days_since_thresholds != None else get_days_since_thresholds()
+    values = cube.get_level_values(level)
+    present = ~np.isnan(values).all(axis = 0)
+    if state == None or state["start_date"] != cube.start_date or state["metrics"] != list(cube.metrics) or state["thresholds"] != thresholds or state["ndays"] > present.shape[1]:
+        return None
+    for k, v in context.items():
+        if k not in row_context + location_context and get_context_hash(v) != state["context"].get(k):
+            logging.info("{} context {} changed. Generating all items".format(name, k))
+            return None
+    keys = cube.get_level(level)["keys"]
+    location_stats = compute_location_stats(values, present, cube.start_date, cube.metrics, thresholds)
+    row_hashes = dict([[k, np.split(get_row_hashes(context[k], get_row_index(keys, present, cube.start_date)), np.cumsum(present.sum(axis = 1))[:-1])] for k in row_context])
+    location_hashes = dict([[k, get_row_hashes(context[k], pd.Index(keys, dtype = object))] for k in location_context])
+    prevs = [state["locations"].get(key) for key in keys]
+    first_days = np.array([get_first_changed_day(state, prev, values, present, n, row_hashes, location_hashes, location_stats) for n, prev in enumerate(prevs)], dtype = np.int64)
+    generated = []
+    if (present & (np.arange(present.shape[1]) >= first_days[:, None])).any():
+        series_stats = compute_level_stats(cube, level, thresholds, first_days)
+        generated = generate_level_items(generate_item, series_stats, context, nprocess, name, chunksize)
+    items = []
+    start = 0
+    carried = 0
+    patched = 0
+    for n, prev in enumerate(prevs):
+        if first_days[n] > 0:
+            prev_items = prev["items"][:np.searchsorted(prev["days"], first_days[n])]
+            stats = get_location_stat_values(location_stats, n)
+            if len(prev_items) > 0 and not all(is_same_value(stats[k], prev["location_stats"][k]) for k in location_stat_columns):
+                for item in prev_items:
+                    update_location_stats(item, stats)
+                patched += len(prev_items)
+            items.extend(prev_items)
+            carried += len(prev_items)
+        count = int(present[n, first_days[n]:].sum())
+        items.extend(generated[start:start + count])
+        start += count
+    logging.info("{} items: {} generated, {} carried forward of which {} updated".format(name, len(generated), carried, patched))
+    return items
+
+# Items of level of cube in mode full, incremental or verify. Full generates every item and neither reads nor writes state.
+# Incremental falls back to generating every item when there is no usable state in state_path. Verify generates both and logs
+# items that differ, then keeps the full items. Both save the state of the items for the next run
+def get_level_items(generate_item, cube, level, context, nprocess, name, chunksize, state_path, mode, days_since_thresholds = None, row_context = [], location_context = []):
+    if mode == "full":
+        return generate_level_items(generate_item, compute_level_stats(cube, level, days_since_thresholds), context, nprocess, name, chunksize)
+    items = update_level_items(generate_item, cube, level, context, nprocess, name, chunksize, load_item_state(state_path), days_since_thresholds, row_context, location_context)
+    if items == None or mode == "verify":
+        full_items = generate_level_items(generate_item, compute_level_stats(cube, level, days_since_thresholds), context, nprocess, name, chunksize)
+        if items != None:
+            mismatches = [i for i, (a, b) in enumerate(zip(items, full_items)) if not is_same_item(a, b)]
+            for i in mismatches[:10]:
+                logging.warning("{} item {} differs: {}".format(name, full_items[i]["_id"], sorted(k for k in set(items[i]) | set(full_items[i]) if k not in items[i] or k not in full_items[i] or not is_same_value(items[i][k], full_items[i][k]))))
+            logging.info("Verified {} incremental items against full generation: {} of {} differ".format(name, len(mismatches) + abs(len(items) - len(full_items)), len(full_items)))
+        items = full_items
+    save_item_state(state_path, build_item_state(cube, level, context, items, days_since_thresholds, row_context, location_context))
+    return items
@@ -0,0 +1,82 @@
+import os
+import pandas as pd
+
+# Key column and static attributes of every location level. Attributes are the same on every row of a location
+location_levels = {
+    "country": ["computed_country_iso3", [
+        "computed_country_name",
+        "computed_country_pop",
+        "computed_region_wb",
+        "computed_country_lat",
+        "computed_country_long",
+        "gdp_update_year",
+        "country_gdp"
+    ]],
+    "state": ["computed_state_iso3", [
+        "computed_state_name",
+        "computed_state_pop",
+        "computed_state_lat",
+        "computed_state_long",
+        "computed_country_name",
+        "computed_country_iso3",
+        "computed_country_pop",
+        "computed_region_wb",
+        "gdp_update_year",
+        "country_gdp"
+    ]],
+    "county": ["computed_county_iso3", [
+        "computed_county_name",
+        "computed_county_pop",
+        "computed_county_lat",
+        "computed_county_long",
+        "computed_state_name",
+        "computed_state_iso3",
+        "computed_state_pop",
+        "computed_country_name",
+        "computed_country_iso3",
+        "computed_country_pop",
+        "computed_region_wb",
+        "gdp_update_year",
+        "country_gdp"
+    ]],
+    "region": ["computed_region_wb", []],
+    "city": ["computed_city_iso3", [
+        "computed_city_name",
+        "Lat",
+        "Long",
+        "computed_country_name",
+        "computed_metro_pop"
+    ]],
+    "metro": ["computed_metro_cbsa", [
+        "computed_metro_name",
+        "computed_metro_pop",
+        "computed_metro_lat",
+        "computed_metro_long",
+        "computed_country_name",
+        "computed_region_wb"
+    ]]
+}
+
+# Columns of daily_df that change from day to day. Testing columns are added to these
+fact_columns = ["date", "Confirmed", "Recovered", "Deaths"]
+
+# Location table of every level indexed by its key column. Attributes come from the first row of each location
+def build_location_tables(daily_df):
+    locations = {}
+    for level, (key, columns) in location_levels.items():
+        locations[level] = daily_df.reindex(columns = [key] + columns).dropna(subset = [key]).drop_duplicates(key).set_index(key)
+    return locations
+
+# Keys of every level, date, counts and testing data of daily_df. Item stats are computed from these
+def get_daily_facts(daily_df):
+    keys = [key for key, columns in location_levels.values()]
+    testing_columns = [i for i in daily_df.columns if "testing_" in i]
+    return daily_df[keys + fact_columns + testing_columns]
+
+# Location tables are exported next to the daily facts
+def get_locations_path(export_df_path):
+    return os.path.splitext(export_df_path)[0] + "_locations.csv"
+
+def export_daily_facts(daily_df, locations, export_df_path):
+    daily_df.to_csv(export_df_path)
+    pd.concat(locations, names = ["level", "key"], sort = False).to_csv(get_locations_path(export_df_path))
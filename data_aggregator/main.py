@@ -3,15 +3,36 @@ import pandas as pd
 import os
 import sys
 from datetime import datetime as dt
-import fiona
-import multiprocessing
-from itertools import repeat
 import numpy as np
 import json
 import re
 import configparser
-from data_aggregator.geometry     import get_centroid, get_closest_polygon, check_point_in_polygon, get_distance_from_polygon
-from data_aggregator.daily_report import read_daily_report, add_lat_long, get_us_admn2_feat, fix_daily_reports
+from data_aggregator.geometry     import (
+                                          GeometryStore,
+                                          get_admn0_key,
+                                          get_admn1_key,
+                                          get_admn2_key,
+                                          get_metro_key,
+                                          get_state_fips_key,
+                                          get_centroid,
+                                          get_closest_polygon,
+                                          check_point_in_polygon,
+                                          get_distance_from_polygon,
+                                          get_parent_feats,
+                                         )
+from data_aggregator.spatial_index import SpatialIndex
+from data_aggregator.shapefile_cache import open_shapefile
+from data_aggregator.centroids    import get_centroid_table_path, load_centroid_table, get_key_centroids
+from data_aggregator.geo_cache    import GeoJoinCache, quantize_coords
+from data_aggregator.raster_grid  import load_raster_grid
+from data_aggregator.daily_report import read_daily_reports, add_lat_long, get_us_admn2_feat, fix_daily_reports
+from data_aggregator.report_cache import DailyReportCache
+from data_aggregator.frame        import compact_frame, log_memory
+from data_aggregator.nyt          import read_nyt_counties
+from data_aggregator.locations    import location_levels, build_location_tables, get_daily_facts, export_daily_facts
+from data_aggregator.rollup       import Rollup
+from data_aggregator.cube         import build_count_cube, load_epi_cube
+from data_aggregator.incremental  import get_level_items, get_item_state_path
 from data_aggregator.stats        import (
                                           compute_days_since,
                                           compute_doubling_rate,
@@ -23,11 +44,19 @@ from data_aggregator.stats        import (
                                           generate_country_item,
                                           get_metro_feat,
                                           compute_stats,
-                                          populate_country,
-                                          populate_state,
-                                          populate_non_us_state,
-                                          populate_us_county,
-                                          populate_us_metro,
+                                          compute_level_stats,
+                                          get_days_since_thresholds,
+                                         )
+from data_aggregator.dimensions   import (
+                                          country_attrs,
+                                          state_attrs,
+                                          county_attrs,
+                                          metro_attrs,
+                                          build_dimension_table,
+                                          get_feats,
+                                          get_coords_feats,
+                                          join_dimension,
+                                          attach_dimension,
                                          )
 import time
 import logging
@@ -55,6 +84,12 @@ if __name__ == "__main__":
     admn2_path = config["shapefiles"]["admn2_path"]
     usa_metro_path = config["shapefiles"]["usa_metro_path"]
 
+    # Simplified geoJSON
+    simplified_admn0_path = config["simplified_shapefiles"]["admn0_path"]
+    simplified_admn1_path = config["simplified_shapefiles"]["admn1_path"]
+    simplified_admn2_path = config["simplified_shapefiles"]["admn2_path"]
+    simplified_usa_metro_path = config["simplified_shapefiles"]["usa_metro_path"]
+
     # Data
     census_regions_path = config["data"]["census_regions_path"]
     gdp_path = config["data"]["gdp_path"]
@@ -67,105 +102,89 @@ if __name__ == "__main__":
     # Output
     export_df_path = config["output"]["export_df_path"]
     out_json_path = config["output"]["out_json_path"]
+    cube_path = config["output"].get("cube_path", fallback = os.path.splitext(export_df_path)[0] + "_cube.npy")
 
     # Processes
     nprocess = int(config["process"]["nprocess"])
-
-    # Read shapefiles
-    admn0_shp = fiona.open(admn0_path)
-    admn1_shp = fiona.open(admn1_path)
-    usa_admn2_shp = fiona.open(admn2_path)
-    usa_metro_shp = fiona.open(usa_metro_path)
+    hierarchical_geo_join = config["process"].getboolean("hierarchical_geo_join", fallback = False)
+    raster_resolution = config["process"].getfloat("raster_resolution", fallback = None)
+    nyt_chunksize = config["process"].getint("nyt_chunksize", fallback = 100000)
+    item_chunksize = config["process"].getint("item_chunksize", fallback = 50)
+    stats_mode = config["process"].get("stats_mode", fallback = "full")
+    # Thresholds of daysSince<n>Cases and daysSince<n>Deaths
+    days_since_thresholds = get_days_since_thresholds(
+        [int(i) for i in config["process"].get("days_since_cases", fallback = "100").split(",")],
+        [int(i) for i in config["process"].get("days_since_deaths", fallback = "10,50").split(",")]
+    )
+
+    # Cache
+    cache_dir = config.get("cache", "cache_dir", fallback = os.path.join(os.path.dirname(export_df_path), "cache"))
+    os.makedirs(cache_dir, exist_ok = True)
+    items_dir = os.path.join(cache_dir, "items")
+    os.makedirs(items_dir, exist_ok = True)
+
+    # Read shapefiles from binary cache. Geometries are decoded only when first used
+    admn0_store = GeometryStore(open_shapefile(admn0_path, cache_dir), get_admn0_key)
+    admn1_store = GeometryStore(open_shapefile(admn1_path, cache_dir), get_admn1_key, state_fips = get_state_fips_key)
+    usa_admn2_store = GeometryStore(open_shapefile(admn2_path, cache_dir), get_admn2_key)
+    usa_metro_store = GeometryStore(open_shapefile(usa_metro_path, cache_dir), get_metro_key)
+
+    # Centroids of every feature. Rebuilt only when shapefile changes
+    admn0_centroids = load_centroid_table(admn0_store, admn0_path, get_centroid_table_path(simplified_admn0_path))
+    admn1_centroids = load_centroid_table(admn1_store, admn1_path, get_centroid_table_path(simplified_admn1_path))
+    usa_admn2_centroids = load_centroid_table(usa_admn2_store, admn2_path, get_centroid_table_path(simplified_admn2_path))
+    usa_metro_centroids = load_centroid_table(usa_metro_store, usa_metro_path, get_centroid_table_path(simplified_usa_metro_path))
 
     #######################
     # Parse daily reports #
     #######################
 
-    daily_reports = [read_daily_report(os.path.join(daily_reports_path, i)) for i in os.listdir(daily_reports_path) if i[-4:] == ".csv"]
-
-    daily_df = pd.concat(daily_reports, ignore_index = True)
-    fix_daily_reports(daily_df, admn0_shp)
+    # Only reports added or changed since the last run are parsed
+    report_cache = DailyReportCache(os.path.join(cache_dir, "daily_reports"))
+    daily_df = read_daily_reports(daily_reports_path, nprocess, report_cache)
+    report_cache.save()
+    daily_df = fix_daily_reports(daily_df, admn0_store)
+    daily_df = compact_frame(daily_df, "daily reports")
 
 
-    # Replace US counts with data from NYT
-    nyt_county = pd.read_csv(nyt_county_path, dtype = {
-        "fips": str
-    })
+    # Replace US counts with data from NYT. County file is streamed in chunks, adding Lat Long and summing per state and date
+    nyt_county, county_group = read_nyt_counties(nyt_county_path, get_key_centroids(usa_admn2_store, usa_admn2_centroids), nyt_chunksize)
     nyt_state = pd.read_csv(nyt_state_path, dtype = {
         "fips": str
     })
-
-    # Map territory fips to adm0_a3 code
-    fips_iso3 = {
-        "VIR": "52",
-        "GUM": "66",
-        "MNP": "69",
-        "VIR": "78",
-        "PRI": "72",
-        "ASM": "60"
-    }
+    nyt_state["date"] = pd.to_datetime(nyt_state["date"], format = "%Y-%m-%d")
 
     # Extract matching features from NE shapefiles
-    usa_admn1_shp = [i for i in admn1_shp if i["properties"]["adm0_a3"] in fips_iso3.keys() or i["properties"]["adm0_a3"] == "USA"]
     def extract_us_state_feats(state_fips):
         us_state_feats = {}
         for fips in state_fips:
-            feats = [i for i in usa_admn1_shp if (i["properties"]["fips"] != None and i["properties"]["fips"][2:] == fips) or (i["properties"]["adm0_a3"] != "USA" and fips_iso3[i["properties"]["adm0_a3"]] == fips)]
-            if len(feats) == 0:
+            ind = admn1_store.lookup(fips, "state_fips")
+            if ind == None:
                 logging.warning("NYT Data doesn't have matching for state with fips {}".format(fips))
-                assert False, "FIPS for NYT data missing. Please add iso3 code to fips_iso3 dict on line 205"
-            us_state_feats[fips] = feats[0]
+                assert False, "FIPS for NYT data missing. Please add iso3 code to fips_iso3 dict in data_aggregator/geometry.py"
+            us_state_feats[fips] = ind
 
         return us_state_feats
 
     us_state_feats = extract_us_state_feats(nyt_state["fips"].unique())
 
+    # FIPS, CBSA and state FIPS are hash lookups on the stores built while reading the shapefiles
     county_fips_list = nyt_county["fips"].dropna().unique().tolist()
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        usa_admn2_feats = pool.starmap(get_us_admn2_feat, zip(county_fips_list, repeat(list(usa_admn2_shp))))
-        pool.close()
-        pool.join()
-
-    usa_admn2_feats = dict(zip(county_fips_list, usa_admn2_feats))
-
-    # Add lat long from extracted features
-    # For NYC and KC add admin_level = 1.7 and a new FIPS code called 
-    # Drop county level data for non mainland US counties except for New York city and Kansas city
-    nyt_county = nyt_county[~nyt_county["fips"].isna() | (nyt_county["county"].isin(["New York City", "Kansas City"]))]
-    for ind, row in nyt_county.iterrows():
-        if pd.isna(row["fips"]):
-            if row["county"] == "New York City" and row["state"] == "New York":
-                nyt_county.loc[ind, "Lat"] = 40.730610
-                nyt_county.loc[ind, "Long"] = 73.935242
-                continue
-            if row["county"] == "Kansas City" and row["state"] == "Missouri":
-                nyt_county.loc[ind, "Lat"] = 39.09973
-                nyt_county.loc[ind, "Long"] = -94.57857
-                continue
-            continue
-        nyt_county.loc[ind, "Lat"], nyt_county.loc[ind, "Long"] = get_centroid(usa_admn2_feats[row["fips"]]["geometry"])
+    usa_admn2_feats = dict([[i, get_us_admn2_feat(i, usa_admn2_store)] for i in county_fips_list])
 
-    nyt_county = nyt_county.rename(columns={
-        "state": "Province_State",
-        "county": "Admin2",
-        "cases": "Confirmed",
-        "deaths": "Deaths"
-    })
-    nyt_county.loc[:,"Country_Region"] = "USA_NYT"  # To differentiate between cruises with country_region US
     logging.info("🕡 NYT COUNTY OVER")
 
     # Add state data. If county counts is less than total state counts then add difference as Admin2 "Unassigned" and Admin1 as "State"
-    county_group = nyt_county.groupby(["Province_State", "date"]).sum()
-    for ind, row in nyt_state.iterrows():
-        nyt_state.loc[ind, "Lat"], nyt_state.loc[ind, "Long"] = get_centroid(us_state_feats[row["fips"]]["geometry"])
-        if row["state"] not in county_group.index.get_level_values(0):  # State not found in county
-            continue
-        if row["date"] in county_group.loc[row["state"],:].index:
-            nyt_state.loc[ind, "cases"] = row["cases"] - county_group.loc[(row["state"], row["date"]), "Confirmed"]
-            nyt_state.loc[ind, "deaths"] = row["deaths"] - county_group.loc[(row["state"], row["date"]), "Deaths"]
-
-    nyt_state["cases"] = nyt_state["cases"].apply(lambda x: x if x>0 else 0)
-    nyt_state["death"] = nyt_state["deaths"].apply(lambda x: x if x>0 else 0)
+    us_state_centroids = admn1_centroids.loc[[us_state_feats[i] for i in us_state_feats]]
+    us_state_centroids.index = list(us_state_feats.keys())
+    nyt_state["Lat"] = nyt_state["fips"].map(us_state_centroids["long"])
+    nyt_state["Long"] = nyt_state["fips"].map(us_state_centroids["lat"])
+    county_sums = nyt_state.merge(county_group, left_on = ["state", "date"], right_index = True, how = "left")
+    nyt_state["cases"] = nyt_state["cases"] - county_sums["Confirmed"].fillna(0).values
+    nyt_state["deaths"] = nyt_state["deaths"] - county_sums["Deaths"].fillna(0).values
+
+    nyt_state["cases"] = nyt_state["cases"].where(nyt_state["cases"] > 0, 0)
+    nyt_state["death"] = nyt_state["deaths"].where(nyt_state["deaths"] > 0, 0)
     nyt_state = nyt_state[~((nyt_state["cases"] == 0) & (nyt_state["deaths"] == 0))]
     nyt_state.loc[:,"Admin2"] = "Unassigned"
     nyt_state.loc[:,"Country_Region"] = "USA_NYT"
@@ -175,10 +194,6 @@ if __name__ == "__main__":
         "deaths": "Deaths"
     })
 
-    # Covnert date to datetime object
-    nyt_county["date"] = nyt_county["date"].apply(lambda x: dt.strptime(x,  "%Y-%m-%d"))
-    nyt_state["date"] = nyt_state["date"].apply(lambda x: dt.strptime(x,  "%Y-%m-%d"))
-
     # Remove US data from daily_df except for cruise ships by checking lat == 91 and long == 181
     daily_df = daily_df[(daily_df["Country_Region"] != "US") | ((daily_df["Lat"] == 91) & (daily_df["Long"] != 181))]
     daily_df = pd.concat([daily_df, nyt_state, nyt_county], ignore_index = True)
@@ -193,17 +208,13 @@ if __name__ == "__main__":
     metro = metro[~metro["FIPS County Code"].isna()]  # Gets rid of bottom 3 rows in file
     metro["fips"] = metro["FIPS State Code"] + metro["FIPS County Code"].apply(lambda x: x.zfill(3))
     daily_df = pd.merge(daily_df, metro, on = "fips", how="left")
+    # Cruises are renamed below so their name columns stay strings until the dataframe is populated
+    daily_df = compact_frame(daily_df, "NYT and metro merge", exclude = ["Province_State", "Country_Region"])
 
-    metro_feats = []
     metro_list = daily_df["CBSA Code"].dropna().unique()
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        metro_feats = pool.starmap(get_metro_feat, zip(metro_list, repeat(list(usa_metro_shp))))
-        pool.close()
-        pool.join()
-
-    metro_feats = dict(zip(metro_list, metro_feats))
+    metro_feats = dict([[i, get_metro_feat(i, usa_metro_store)] for i in metro_list])
 
-    us_testing = get_us_testing_data(admn1_shp)
+    us_testing = get_us_testing_data(admn1_store)
 
     #################################################
     # Compute geo joins for countries other than US #
@@ -214,19 +225,29 @@ if __name__ == "__main__":
 
     logging.info("Computing geo joins ... ")
 
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        # Country
-        lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"].groupby(["Lat", "Long"])]
-        feats = pool.starmap(get_closest_polygon, zip(lat_lng, repeat(list(admn0_shp))))
-        country_feats = dict(zip(lat_lng, feats))
-        # State
-        lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"][~daily_df["Province_State"].isna()].groupby(["Lat", "Long"])]
-        feats = pool.starmap(get_closest_polygon, zip(lat_lng, repeat(list(admn1_shp))))
-        state_feats = dict(zip(lat_lng, feats))
-        pool.close()
-        pool.join()
+    # Raster grid resolves points away from borders with one array lookup. Others use the R-tree
+    def get_join_index(store, shp_path, name):
+        index = SpatialIndex(store)
+        if raster_resolution == None:
+            return index
+        return load_raster_grid(store, shp_path, os.path.join(cache_dir, "raster_grid_{}.npy".format(name)), raster_resolution, index)
+
+    # State
+    admn1_cache = GeoJoinCache(os.path.join(cache_dir, "geo_join_admn1.json"), admn1_path)
+    lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"][~daily_df["Province_State"].isna()].groupby(["Lat", "Long"])]
+    state_feats = admn1_cache.join(lat_lng, lambda: get_join_index(admn1_store, admn1_path, "admn1"))
+    admn1_cache.save()
+    # Country. In hierarchical mode country of points matched to admin1 is the adm0_a3 of that feature.
+    admn0_cache = GeoJoinCache(os.path.join(cache_dir, "geo_join_admn0.json"), admn0_path)
+    lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"].groupby(["Lat", "Long"])]
+    country_feats = get_parent_feats(state_feats, admn1_store, admn0_store) if hierarchical_geo_join else {}
+    lat_lng = [i for i in lat_lng if quantize_coords(*i) not in country_feats]
+    logging.info("Derived {} country joins from admin1. Joining {} points with admin0".format(len(country_feats), len(lat_lng)))
+    country_feats.update(admn0_cache.join(lat_lng, lambda: get_join_index(admn0_store, admn0_path, "admn0")))
+    admn0_cache.save()
 
     logging.info("Completed geo joins.")
+    log_memory(daily_df, "geo joins")
 
     logging.info("Populating dataframe ... ")
 
@@ -241,7 +262,13 @@ if __name__ == "__main__":
         "Grand Princess": 3533
     }
 
-    usa_country_feat = [i for i in admn0_shp if i["properties"]["ADM0_A3"]=="USA"][0]
+    usa_country_feat = admn0_store.lookup("USA")
+
+    # One row per feature with the attributes and centroid copied to daily_df
+    country_dim = build_dimension_table(admn0_store, country_attrs, admn0_centroids, "computed_country")
+    state_dim = build_dimension_table(admn1_store, state_attrs, admn1_centroids, "computed_state")
+    county_dim = build_dimension_table(usa_admn2_store, county_attrs, usa_admn2_centroids, "computed_county")
+    metro_dim = build_dimension_table(usa_metro_store, metro_attrs, usa_metro_centroids, "computed_metro")
 
     daily_df.columns = daily_df.columns.str.replace(" ", "_").str.replace("/", "")
 
@@ -266,16 +293,16 @@ if __name__ == "__main__":
 
     # Country
     logging.info("Populating countries ... ")
-    tmp = daily_df.apply(populate_country, axis =  1)
-    for i in tmp.columns:
-        daily_df.loc[tmp.index, i] = tmp[i]
+    feats = get_coords_feats(daily_df, country_feats)
+    feats[(daily_df["Country_Region"] == "USA_NYT").values] = usa_country_feat
+    tmp = join_dimension(country_dim, daily_df.index, feats)
+    attach_dimension(daily_df, tmp)
 
     # US States set lat. For New York City and Kansas City, lat_lng already set
     logging.info("Populating US States ... ")
     us_states = daily_df.loc[~daily_df["Province_State"].isna() & (daily_df["Country_Region"] == "USA_NYT") & (~daily_df["Admin2"].isin(["New York City", "Kansas City"]))]
-    tmp = us_states.apply(populate_state, axis= 1)
-    for i in tmp.columns:
-        daily_df.loc[tmp.index, i] = tmp[i]
+    tmp = join_dimension(state_dim, us_states.index, get_feats(us_states["fips"].astype(object).str[:2], us_state_feats))
+    attach_dimension(daily_df, tmp)
 
     # Add testing data to states in US
     us_states = daily_df.loc[~daily_df["Province_State"].isna() & (daily_df["Country_Region"] == "USA_NYT") & (~daily_df["Admin2"].isin(["New York City", "Kansas City"]))]
@@ -294,23 +321,21 @@ if __name__ == "__main__":
     logging.info("Populating Admin1 regions outside US ... ")
     non_us_states = daily_df.loc[~daily_df["Province_State"].isna() & (daily_df["Country_Region"] != "USA_NYT") & (~daily_df["Admin2"].isin(["New York City", "Kansas City"]))]
 
-    tmp = non_us_states.apply(populate_non_us_state, axis= 1)
-    for i in tmp.columns:
-        daily_df.loc[tmp.index, i] = tmp[i]
+    # Population is only set for US states
+    tmp = join_dimension(state_dim, non_us_states.index, get_coords_feats(non_us_states, state_feats), [i for i in state_dim.columns if i != "computed_state_pop"])
+    attach_dimension(daily_df, tmp)
 
     # Admin2
     logging.info("Populating US counties ... ")
     us_county_df = daily_df[~daily_df["Province_State"].isna() & (daily_df["Country_Region"] == "USA_NYT") & ~(daily_df["Admin2"] == "Unassigned") & ~(pd.isna(daily_df["Admin2"])) & ~(daily_df["Admin2"].isin(["New York City", "Kansas City"]))]
-    tmp = us_county_df.apply(populate_us_county, axis= 1)
-    for i in tmp.columns:
-        daily_df.loc[tmp.index, i] = tmp[i]
+    tmp = join_dimension(county_dim, us_county_df.index, get_feats(us_county_df["fips"], usa_admn2_feats))
+    attach_dimension(daily_df, tmp)
 
     # Add metropolitan areas
     logging.info("Populating metropolitan areas ...")
     us_metro_df = us_county_df[~us_county_df["CBSA_Code"].isna()]
-    tmp = us_metro_df.apply(populate_us_metro, axis= 1)
-    for i in tmp.columns:
-        daily_df.loc[tmp.index, i] = tmp[i]
+    tmp = join_dimension(metro_dim, us_metro_df.index, get_feats(us_metro_df["CBSA_Code"], metro_feats))
+    attach_dimension(daily_df, tmp)
 
     # Add admin2 codes for cities: NYC and KC
     logging.info("Populating cities (NYC + KC)")
@@ -320,19 +345,19 @@ if __name__ == "__main__":
     daily_df.loc[nyc_df.index, "computed_city_lat"] = nyc_df["Lat"]
     daily_df.loc[nyc_df.index, "computed_city_long"] = nyc_df["Long"]
     metro_feat = metro_feats["35620"]
-    daily_df.loc[nyc_df.index, "computed_metro_cbsa"] = metro_feat["properties"]["CBSAFP"]
-    daily_df.loc[nyc_df.index, "computed_metro_name"] = metro_feat["properties"]["NAME"]
-    daily_df.loc[nyc_df.index, "computed_metro_pop"] = metro_feat["properties"]["POPESTI"]
-    centroid = get_centroid(metro_feat["geometry"])
-    daily_df.loc[nyc_df.index, "computed_metro_long"] = centroid[0]
-    daily_df.loc[nyc_df.index, "computed_metro_lat"] = centroid[1]
+    daily_df.loc[nyc_df.index, "computed_metro_cbsa"] = usa_metro_store.properties[metro_feat]["CBSAFP"]
+    daily_df.loc[nyc_df.index, "computed_metro_name"] = usa_metro_store.properties[metro_feat]["NAME"]
+    daily_df.loc[nyc_df.index, "computed_metro_pop"] = usa_metro_store.properties[metro_feat]["POPESTI"]
+    centroid = usa_metro_centroids.loc[metro_feat]
+    daily_df.loc[nyc_df.index, "computed_metro_long"] = centroid["long"]
+    daily_df.loc[nyc_df.index, "computed_metro_lat"] = centroid["lat"]
     # Add state for city_df records
-    ny_state_feature = next(i for i in admn1_shp if i["properties"]["i_3166_"] == "US-NY")
-    centroid = get_centroid(ny_state_feature["geometry"])
-    daily_df.loc[nyc_df.index, "computed_state_long"] = centroid[0]
-    daily_df.loc[nyc_df.index, "computed_state_lat"] = centroid[1]
+    ny_state_feature = admn1_store.lookup("US-NY")
+    centroid = admn1_centroids.loc[ny_state_feature]
+    daily_df.loc[nyc_df.index, "computed_state_long"] = centroid["long"]
+    daily_df.loc[nyc_df.index, "computed_state_lat"] = centroid["lat"]
     daily_df.loc[nyc_df.index, "computed_state_iso3"] = "US-NY"
-    daily_df.loc[nyc_df.index, "computed_state_name"] = ny_state_feature["properties"]["name"]
+    daily_df.loc[nyc_df.index, "computed_state_name"] = admn1_store.properties[ny_state_feature]["name"]
 
     kc_df = daily_df[~daily_df["Province_State"].isna() & (daily_df["Country_Region"] == "USA_NYT") & (daily_df["Admin2"] == "Kansas City")]
     daily_df.loc[kc_df.index, "computed_city_name"] = "Kansas City"
@@ -340,19 +365,19 @@ if __name__ == "__main__":
     daily_df.loc[kc_df.index, "computed_city_lat"] = kc_df["Lat"]
     daily_df.loc[kc_df.index, "computed_city_long"] = kc_df["Long"]
     metro_feat = metro_feats["28140"]
-    daily_df.loc[kc_df.index, "computed_metro_cbsa"] = metro_feat["properties"]["CBSAFP"]
-    daily_df.loc[kc_df.index, "computed_metro_name"] = metro_feat["properties"]["NAME"]
-    daily_df.loc[kc_df.index, "computed_metro_pop"] = metro_feat["properties"]["POPESTI"]
-    centroid = get_centroid(metro_feat["geometry"])
-    daily_df.loc[kc_df.index, "computed_metro_long"] = centroid[0]
-    daily_df.loc[kc_df.index, "computed_metro_lat"] = centroid[1]
+    daily_df.loc[kc_df.index, "computed_metro_cbsa"] = usa_metro_store.properties[metro_feat]["CBSAFP"]
+    daily_df.loc[kc_df.index, "computed_metro_name"] = usa_metro_store.properties[metro_feat]["NAME"]
+    daily_df.loc[kc_df.index, "computed_metro_pop"] = usa_metro_store.properties[metro_feat]["POPESTI"]
+    centroid = usa_metro_centroids.loc[metro_feat]
+    daily_df.loc[kc_df.index, "computed_metro_long"] = centroid["long"]
+    daily_df.loc[kc_df.index, "computed_metro_lat"] = centroid["lat"]
     # Add state for city_df records
-    mo_state_feature = next(i for i in admn1_shp if i["properties"]["i_3166_"] == "US-MO")
-    centroid = get_centroid(mo_state_feature["geometry"])
-    daily_df.loc[kc_df.index, "computed_state_long"] = centroid[0]
-    daily_df.loc[kc_df.index, "computed_state_lat"] = centroid[1]
+    mo_state_feature = admn1_store.lookup("US-MO")
+    centroid = admn1_centroids.loc[mo_state_feature]
+    daily_df.loc[kc_df.index, "computed_state_long"] = centroid["long"]
+    daily_df.loc[kc_df.index, "computed_state_lat"] = centroid["lat"]
     daily_df.loc[kc_df.index, "computed_state_iso3"] = "US-MO"
-    daily_df.loc[kc_df.index, "computed_state_name"] = mo_state_feature["properties"]["name"]
+    daily_df.loc[kc_df.index, "computed_state_name"] = admn1_store.properties[mo_state_feature]["name"]
 
     # Add GDP data
     logging.info("Adding GDP per capita for countries")
@@ -372,103 +397,110 @@ if __name__ == "__main__":
     gdp_trim_df = pd.DataFrame(new_rows, columns=["computed_country_iso3","gdp_update_year","country_gdp"])
 
     daily_df = pd.merge(daily_df,gdp_trim_df,on="computed_country_iso3")
+    daily_df = compact_frame(daily_df, "populating dataframe")
 
 
+    # Static attributes of every location move to location tables. daily_df keeps location keys, date, counts and testing data
+    locations = build_location_tables(daily_df)
+    daily_df = get_daily_facts(daily_df)
+    log_memory(daily_df, "splitting location tables")
+
     logging.info("Dataframe ready")
 
-    # Export dataframe
-    daily_df.to_csv(export_df_path)
+    # Export daily facts and location tables
+    export_daily_facts(daily_df, locations, export_df_path)
 
     ###########################
     #Generate items and stats #
     ###########################
 
     format_id = lambda x: x.replace(" ", "_").replace("&", "_")
+    count_columns = ["Confirmed", "Recovered", "Deaths"]
+
+    # Counts of every level are summed from one pass over daily_df and kept in the cube. Stats of each level are computed
+    # from the saved cube, memory mapped, so the in memory rollup and cube are released
+    rollup = Rollup(daily_df, [key for key, columns in location_levels.values()], count_columns)
+    build_count_cube(rollup, dict([[level, key] for level, (key, columns) in location_levels.items()])).save(cube_path)
+    del rollup
+    cube = load_epi_cube(cube_path)
 
     items = []
 
     # Compute sub_national from latest dates for all countries
     logging.info("Generating admin0 items ... ")
 
-    country_sub_national = daily_df.sort_values("date").groupby(["computed_country_iso3"]).apply(lambda x: len(x[x["date"] == x["date"].max()]["computed_state_iso3"].unique())).sort_values()
-    grouped_sum = daily_df.groupby(["computed_country_iso3", "date"]).sum()
+    country_sub_national = daily_df.sort_values("date").groupby(["computed_country_iso3"], observed = True).apply(lambda x: len(x[x["date"] == x["date"].max()]["computed_state_iso3"].unique())).sort_values()
 
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        country_items = pool.starmap(generate_country_item, zip(daily_df.sort_values("date").groupby(["computed_country_iso3", "date"]), repeat(grouped_sum), repeat(country_sub_national)))
-        pool.close()
-        pool.join()
-        items.extend(country_items)
-        logging.info("Completed generation of {} admin0 items.".format(len(country_items)))
+    country_items = get_level_items(generate_country_item, cube, "country", {
+        "country_sub_national": country_sub_national,
+        "locations": locations["country"]
+    }, nprocess, "admin0", item_chunksize, get_item_state_path(items_dir, "admin0"), stats_mode, days_since_thresholds, location_context = ["locations", "country_sub_national"])
+    items.extend(country_items)
+    logging.info("Completed generation of {} admin0 items.".format(len(country_items)))
 
     logging.info("Generating admin1 items ... ")
 
-    grouped_sum = daily_df.groupby(["computed_state_iso3", "date"]).sum()
+    testing_columns = [i for i in daily_df.columns if "testing_" in i]
+    testing = daily_df.drop_duplicates(["computed_state_iso3", "date"]).set_index(["computed_state_iso3", "date"])[testing_columns]
 
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        testing_columns = [i for i in daily_df.columns if "testing_" in i]
-        state_items = pool.starmap(generate_state_item, zip(daily_df.groupby(["computed_state_iso3", "date"]), repeat(grouped_sum), repeat(testing_columns)))
-        pool.close()
-        pool.join()
-        items.extend(state_items)
-        logging.info("Completed generation of {} admin1 items".format(len(state_items)))
+    state_items = get_level_items(generate_state_item, cube, "state", {
+        "testing": testing,
+        "locations": locations["state"]
+    }, nprocess, "admin1", item_chunksize, get_item_state_path(items_dir, "admin1"), stats_mode, days_since_thresholds, row_context = ["testing"], location_context = ["locations"])
+    items.extend(state_items)
+    logging.info("Completed generation of {} admin1 items".format(len(state_items)))
 
     logging.info("Generating admin2 items ... ")
-    grouped_sum = daily_df.groupby(["computed_county_iso3", "date"]).sum()
 
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        county_items = pool.starmap(generate_county_item, zip(daily_df.groupby(["computed_county_iso3", "date"]), repeat(grouped_sum)))
-        pool.close()
-        pool.join()
-        items.extend(county_items)
-        logging.info("Completed generation of {} admin2 items.".format(len(county_items)))
+    county_items = get_level_items(generate_county_item, cube, "county", {
+        "locations": locations["county"]
+    }, nprocess, "admin2", item_chunksize, get_item_state_path(items_dir, "admin2"), stats_mode, days_since_thresholds, location_context = ["locations"])
+    items.extend(county_items)
+    logging.info("Completed generation of {} admin2 items.".format(len(county_items)))
 
     logging.info("Generating region_wb items ... ")
-    grouped_sum = daily_df.groupby(["computed_region_wb", "date"]).sum()
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        region_items = pool.starmap(generate_region_item, zip(daily_df.groupby(["computed_region_wb", "date"]), repeat(grouped_sum)))
-        pool.close()
-        pool.join()
-        items.extend(region_items)
-        logging.info("Completed generation of {} region_wb items".format(len(region_items)))
+    region_items = get_level_items(generate_region_item, cube, "region", {}, nprocess, "region_wb", item_chunksize, get_item_state_path(items_dir, "region_wb"), stats_mode, days_since_thresholds)
+    items.extend(region_items)
+    logging.info("Completed generation of {} region_wb items".format(len(region_items)))
 
     # Aggregate cities: KC and NYC
     # Ignore multiprocessing because only 2 cities
     logging.info("Generating city items ... ")
     city_items = []
-    grouped_sum = daily_df.groupby(["computed_city_iso3", "date"]).sum()
-    for ind, grp in daily_df.groupby(["computed_city_iso3", "date"]):
+    series_stats = compute_level_stats(cube, "city", days_since_thresholds)
+    for ind in series_stats.index:
+        loc = locations["city"].loc[ind[0]]
         item = {
             "date": ind[1].strftime("%Y-%m-%d"),
-            "name": grp["computed_city_name"].iloc[0],
-            "cbsa": grp["computed_city_iso3"].iloc[0],
-            "location_id" : format_id("CITY_"+grp["computed_city_iso3"].iloc[0]),
-            "lat": grp["Lat"].iloc[0],
-            "long": grp["Long"].iloc[0],
-            "_id": format_id("CITY_"+grp["computed_city_iso3"].iloc[0] + "_" + ind[1].strftime("%Y-%m-%d")),
+            "name": loc["computed_city_name"],
+            "cbsa": ind[0],
+            "location_id" : format_id("CITY_"+ind[0]),
+            "lat": loc["Lat"],
+            "long": loc["Long"],
+            "_id": format_id("CITY_"+ind[0] + "_" + ind[1].strftime("%Y-%m-%d")),
             "admin_level": 1.7,
-            "country_name": grp["computed_country_name"].iloc[0],
-            "population": grp["computed_metro_pop"].iloc[0]
+            "country_name": loc["computed_country_name"],
+            "population": loc["computed_metro_pop"]
             }
-        compute_stats(item, grp, grouped_sum, ind[0], ind[1])
+        compute_stats(item, series_stats.loc[ind])
         city_items.append(item)
 
     items.extend(city_items)
     logging.info("Completed generation of {} city items ... ".format(len(city_items)))
 
     logging.info("Generating metro items ... ")
-    grouped_sum = daily_df.groupby(["computed_metro_cbsa", "date"]).sum()
-    with multiprocessing.Pool(processes = nprocess) as pool:
-        metro_items = pool.starmap(generate_metro_item, zip(daily_df.groupby(["computed_metro_cbsa", "date"]), repeat(grouped_sum), repeat(metro)))
-        pool.close()
-        pool.join()
-        items.extend(metro_items)
-        logging.info("Completed generation of {} metro items.".format(len(metro_items)))
+    metro_items = get_level_items(generate_metro_item, cube, "metro", {
+        "metro": metro,
+        "locations": locations["metro"]
+    }, nprocess, "metro", item_chunksize, get_item_state_path(items_dir, "metro"), stats_mode, days_since_thresholds, location_context = ["locations"])
+    items.extend(metro_items)
+    logging.info("Completed generation of {} metro items.".format(len(metro_items)))
 
     for item in items:
         for k,v in item.items():
-            if type(v) == np.int64:
+            if isinstance(v, np.integer):
                 item[k] = int(v)
-            if type(v) == np.float64 or type(v) == np.float:
+            if isinstance(v, np.floating):
                 item[k] = float(v)
 
     with open(out_json_path, "w") as fout:
@@ -0,0 +1,73 @@
+import pandas as pd
+import logging
+from pandas.api.types import union_categoricals
+from data_aggregator.frame import downcast_integers
+
+nyt_county_dtypes = {
+    "date": str,
+    "county": str,
+    "state": str,
+    "fips": str,
+    "cases": float,
+    "deaths": float
+}
+
+# Repeated strings of county rows kept as categoricals
+nyt_category_columns = ["Province_State", "Admin2", "fips", "Country_Region"]
+
+# Counties without fips kept in NYT data. Lat, Long of their city
+nyt_cities = {
+    ("New York City", "New York"): (40.730610, 73.935242),
+    ("Kansas City", "Missouri"): (39.09973, -94.57857)
+}
+
+# Drops counties without fips except NYC and KC, adds Lat Long and renames columns to daily report names
+def prepare_nyt_county_chunk(chunk, usa_admn2_centroids):
+    chunk = chunk[~chunk["fips"].isna() | (chunk["county"].isin(["New York City", "Kansas City"]))].copy()
+    chunk["date"] = pd.to_datetime(chunk["date"], format = "%Y-%m-%d")
+    # Lat is set to the centroid longitude and Long to its latitude as before
+    chunk["Lat"] = chunk["fips"].map(usa_admn2_centroids["long"])
+    chunk["Long"] = chunk["fips"].map(usa_admn2_centroids["lat"])
+    for (county, state), (lat, lng) in nyt_cities.items():
+        city = chunk["fips"].isna() & (chunk["county"] == county) & (chunk["state"] == state)
+        chunk.loc[city, "Lat"] = lat
+        chunk.loc[city, "Long"] = lng
+    chunk = chunk.rename(columns={
+        "state": "Province_State",
+        "county": "Admin2",
+        "cases": "Confirmed",
+        "deaths": "Deaths"
+    })
+    chunk["Country_Region"] = "USA_NYT"  # To differentiate between cruises with country_region US
+    return chunk
+
+# Strings of chunk become categoricals and integral counts int32, before the chunk is kept
+def compact_nyt_chunk(chunk):
+    for i in nyt_category_columns:
+        chunk[i] = chunk[i].astype("category")
+    for i in ["Confirmed", "Deaths"]:
+        chunk[i] = downcast_integers(chunk[i])
+    return chunk
+
+# Categories of every chunk are unioned first, so that concat keeps the columns categorical instead of falling back to strings
+def concat_nyt_chunks(chunks):
+    for i in nyt_category_columns:
+        categories = union_categoricals([chunk[i] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[i] = chunk[i].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index = True)
+
+# Reads NYT county file chunksize rows at a time. Returns the county rows and their sums per (Province_State, date).
+# Only one chunk of raw csv is held in memory at a time. The county rows themselves are all kept, compacted chunk by chunk.
+def read_nyt_counties(path, usa_admn2_centroids, chunksize):
+    chunks = []
+    sums = []
+    for chunk in pd.read_csv(path, dtype = nyt_county_dtypes, chunksize = chunksize):
+        chunk = prepare_nyt_county_chunk(chunk, usa_admn2_centroids)
+        sums.append(chunk.groupby(["Province_State", "date"])[["Confirmed", "Deaths"]].sum())
+        chunks.append(compact_nyt_chunk(chunk))
+    nyt_county = concat_nyt_chunks(chunks)
+    # A (state, date) split across two chunks is summed again here
+    county_group = pd.concat(sums).groupby(level = [0, 1]).sum()
+    logging.info("Read {} NYT county rows in {} chunks".format(nyt_county.shape[0], len(chunks)))
+    return nyt_county, county_group
@@ -0,0 +1,91 @@
+import os
+import json
+import numpy as np
+import logging
+from shapely.geometry import box
+from data_aggregator.geometry import get_shapefile_checksum
+
+# Cell values other than feature indices
+OUTSIDE = -1    # No feature touches cell
+AMBIGUOUS = -2  # More than one feature or a border touches cell
+
+# Grid of feature indices covering the globe at resolution degrees. Row 0 starts at latitude -90, column 0 at longitude -180.
+# A cell holds a feature index only if that feature contains the whole cell and no other feature touches it.
+# Every other point falls back to the exact search in index.
+class RasterGrid:
+
+    def __init__(self, grid, resolution, index):
+        self.grid = grid
+        self.resolution = resolution
+        self.index = index
+
+    def get_cell(self, lat, lng):
+        row = int(np.floor((lat + 90) / self.resolution))
+        col = int(np.floor((lng + 180) / self.resolution))
+        if row < 0 or col < 0 or row >= self.grid.shape[0] or col >= self.grid.shape[1]:
+            return OUTSIDE
+        return int(self.grid[row, col])
+
+    # Returns index of feat that contains point or closest feat. Same result as index.get_closest_polygon
+    def get_closest_polygon(self, coords):
+        ind = self.get_cell(*coords)
+        if ind >= 0:
+            return ind
+        return self.index.get_closest_polygon(coords)
+
+# Marks cells [row0, row1) x [col0, col1) covered by feature ind. Blocks partly inside the feature are split in four until they are single cells.
+def rasterize_block(grid, resolution, prepared, ind, row0, row1, col0, col1):
+    block = box(-180 + col0 * resolution, -90 + row0 * resolution, -180 + col1 * resolution, -90 + row1 * resolution)
+    if not prepared.intersects(block):
+        return
+    if prepared.contains(block):
+        cells = grid[row0:row1, col0:col1]
+        cells[cells != OUTSIDE] = AMBIGUOUS
+        cells[cells == OUTSIDE] = ind
+        return
+    if row1 - row0 == 1 and col1 - col0 == 1:
+        grid[row0, col0] = AMBIGUOUS
+        return
+    row_mid = (row0 + row1 + 1) // 2 if row1 - row0 > 1 else row1
+    col_mid = (col0 + col1 + 1) // 2 if col1 - col0 > 1 else col1
+    for r0, r1 in [[row0, row_mid], [row_mid, row1]]:
+        for c0, c1 in [[col0, col_mid], [col_mid, col1]]:
+            if r0 < r1 and c0 < c1:
+                rasterize_block(grid, resolution, prepared, ind, r0, r1, c0, c1)
+
+def build_raster_grid(store, resolution):
+    nrows = int(np.ceil(180 / resolution))
+    ncols = int(np.ceil(360 / resolution))
+    grid = np.full((nrows, ncols), OUTSIDE, dtype = np.int32)
+    for ind in range(len(store)):
+        minx, miny, maxx, maxy = store.geometry(ind).bounds
+        row0 = max(int(np.floor((miny + 90) / resolution)), 0)
+        row1 = min(int(np.floor((maxy + 90) / resolution)) + 1, nrows)
+        col0 = max(int(np.floor((minx + 180) / resolution)), 0)
+        col1 = min(int(np.floor((maxx + 180) / resolution)) + 1, ncols)
+        if row0 < row1 and col0 < col1:
+            rasterize_block(grid, resolution, store.prepared_geometry(ind), ind, row0, row1, col0, col1)
+    return grid
+
+# Memory maps grid saved at path (.npy) or rasterizes store if the shapefile or resolution changed.
+# Header with checksum and resolution is written next to it as .json
+def load_raster_grid(store, shp_path, path, resolution, index):
+    checksum = get_shapefile_checksum(shp_path)
+    header_path = os.path.splitext(path)[0] + ".json"
+    if os.path.exists(path) and os.path.exists(header_path):
+        with open(header_path) as f:
+            header = json.load(f)
+        if header["checksum"] == checksum and header["resolution"] == resolution:
+            logging.info("Memory mapped raster grid {}".format(path))
+            return RasterGrid(np.load(path, mmap_mode = "r"), resolution, index)
+    logging.info("Rasterizing {} at {} degrees".format(shp_path, resolution))
+    grid = build_raster_grid(store, resolution)
+    np.save(path, grid)
+    with open(header_path, "w") as fout:
+        json.dump({
+            "checksum": checksum,
+            "resolution": resolution,
+            "shape": list(grid.shape)
+        }, fout)
+    logging.info("Wrote raster grid to {}. {} of {} cells need exact geometry".format(path, int((grid < 0).sum()), grid.size))
+    return RasterGrid(np.load(path, mmap_mode = "r"), resolution, index)
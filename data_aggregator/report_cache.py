@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import logging
+import pandas as pd
+
+# Bump when read_daily_report output changes so that frames parsed by an older reader are not reused
+READER_VERSION = 2
+
+def get_file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# Parsed daily reports of previous runs. manifest.json in path records size, mtime and md5 of every csv
+# and the pickled frame read_daily_report returned for it. Only new or changed csvs are parsed again.
+class DailyReportCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.files = {}
+        os.makedirs(path, exist_ok = True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest["reader_version"] == READER_VERSION:
+                self.files = manifest["files"]
+            else:
+                logging.info("Daily report reader changed. Discarding parsed reports in {}".format(path))
+
+    def get_frame_path(self, name):
+        return os.path.join(self.path, os.path.splitext(name)[0] + ".pkl")
+
+    # Size and mtime are checked first. md5 is only computed when they differ, so touched but unchanged files are reused
+    def is_fresh(self, name, csv_path):
+        entry = self.files.get(name)
+        if entry == None or not os.path.exists(self.get_frame_path(name)):
+            return False
+        stat = os.stat(csv_path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        if entry["size"] != stat.st_size or entry["md5"] != get_file_md5(csv_path):
+            return False
+        entry["mtime"] = stat.st_mtime
+        return True
+
+    # Returns frames of every csv in daily_reports_path. Csvs not in the manifest or changed since are parsed by read on nprocess workers.
+    def read_all(self, daily_reports_path, read, nprocess = 1):
+        names = sorted(i for i in os.listdir(daily_reports_path) if i[-4:] == ".csv")
+        stale = [i for i in names if not self.is_fresh(i, os.path.join(daily_reports_path, i))]
+        parsed = {}
+        if len(stale) > 0:
+            with multiprocessing.Pool(processes = min(nprocess, len(stale))) as pool:
+                parsed = dict(zip(stale, pool.map(read, [os.path.join(daily_reports_path, i) for i in stale])))
+        frames = []
+        for name in names:
+            if name not in parsed:
+                frames.append(pd.read_pickle(self.get_frame_path(name)))
+                continue
+            csv_path = os.path.join(daily_reports_path, name)
+            parsed[name].to_pickle(self.get_frame_path(name))
+            stat = os.stat(csv_path)
+            self.files[name] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "md5": get_file_md5(csv_path)
+            }
+            frames.append(parsed[name])
+        # Drop reports removed upstream
+        for name in set(self.files) - set(names):
+            if os.path.exists(self.get_frame_path(name)):
+                os.remove(self.get_frame_path(name))
+            del self.files[name]
+        logging.info("Daily reports: {} reused, {} reparsed".format(len(names) - len(stale), len(stale)))
+        return frames
+
+    def save(self):
+        with open(self.manifest_path, "w") as fout:
+            json.dump({
+                "reader_version": READER_VERSION,
+                "files": self.files
+            }, fout)
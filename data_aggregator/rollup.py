@@ -0,0 +1,49 @@
+import logging
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from data_aggregator.cube import get_long_frame
+
+# Counts of daily_df summed once per source, every distinct combination of the location keys of a row, and day.
+# Every level is derived from these by a sparse membership matrix of its locations x sources, so all levels
+# come from one pass over daily_df. A new grouping only needs a key column that maps sources to its locations.
+class Rollup:
+
+    def __init__(self, daily_df, keys, columns):
+        self.columns = columns
+        self.keys = {}
+        codes = []
+        for key in keys:
+            key_codes, self.keys[key] = pd.factorize(daily_df[key], sort = True)
+            codes.append(key_codes)
+        sources, source = np.unique(np.stack(codes, axis = 1), axis = 0, return_inverse = True)
+        self.sources = pd.DataFrame(sources, columns = keys)
+        source = source.reshape(-1)
+        self.start_date = daily_df["date"].min()
+        day = (daily_df["date"] - self.start_date).dt.days.values
+        self.ndays = day.max() + 1
+        flat = source * self.ndays + day
+        size = self.sources.shape[0] * self.ndays
+        # Number of rows of every source and day. A location has a date where any of its sources has a row
+        self.rows = np.bincount(flat, minlength = size).reshape(-1, self.ndays)
+        self.values = np.stack([
+            np.bincount(flat, weights = daily_df[i].fillna(0).values.astype(float), minlength = size).reshape(-1, self.ndays) for i in columns
+        ])
+        logging.info("Rollup of {} rows: {} sources x {} days".format(daily_df.shape[0], self.sources.shape[0], self.ndays))
+
+    # Sparse locations x sources matrix with 1 where the source belongs to the location of key. Sources without key are left out
+    def get_membership_matrix(self, key):
+        codes = self.sources[key].values
+        member = codes >= 0
+        return scipy.sparse.csr_matrix((np.ones(member.sum()), (codes[member], np.nonzero(member)[0])), shape = (len(self.keys[key]), self.sources.shape[0]))
+
+    # Sums of every location of key and day as columns x locations x days. NaN where none of the location's sources has a row
+    def dense(self, key):
+        membership = self.get_membership_matrix(key)
+        values = np.stack([membership.dot(self.values[n]) for n in range(len(self.columns))])
+        values[:, membership.dot(self.rows) == 0] = np.nan
+        return values
+
+    # Same as daily_df.groupby([key, "date"])[columns].sum()
+    def sum(self, key):
+        return get_long_frame(self.dense(key), self.keys[key], self.start_date, key, self.columns)
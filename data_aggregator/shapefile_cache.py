@@ -0,0 +1,92 @@
+import os
+import json
+import numpy as np
+import logging
+from collections.abc import Mapping
+from shapely import wkb
+from shapely.geometry import shape, mapping
+from data_aggregator.geometry import get_shapefile_checksum
+
+# Feature of a CachedShapefile. Behaves like a fiona feature but geometry is decoded from WKB on first access
+class CachedFeature(Mapping):
+
+    def __init__(self, shp, ind):
+        self.shp = shp
+        self.ind = ind
+        self.geometry = None
+
+    def __getitem__(self, k):
+        if k == "type":
+            return "Feature"
+        if k == "properties":
+            return self.shp.properties[self.ind]
+        if k == "geometry":
+            if self.geometry is None:
+                geom = self.shp.get_geometry(self.ind)
+                self.geometry = mapping(geom) if geom is not None else None
+            return self.geometry
+        raise KeyError(k)
+
+    def __iter__(self):
+        return iter(["type", "properties", "geometry"])
+
+    def __len__(self):
+        return 3
+
+# Shapefile converted once to <name>_wkb.npy (all geometries as WKB in one buffer), <name>_offsets.npy (start of each
+# feature in buffer) and <name>.json (checksum and properties by column). Buffers are memory mapped.
+class CachedShapefile:
+
+    def __init__(self, path):
+        with open(path + ".json") as f:
+            header = json.load(f)
+        self.checksum = header["checksum"]
+        self.columns = header["columns"]
+        self.wkb = np.load(path + "_wkb.npy", mmap_mode = "r")
+        self.offsets = np.load(path + "_offsets.npy", mmap_mode = "r")
+        names = list(self.columns.keys())
+        self.properties = [dict(zip(names, i)) for i in zip(*[self.columns[k] for k in names])]
+
+    def __len__(self):
+        return len(self.properties)
+
+    def __iter__(self):
+        return (CachedFeature(self, ind) for ind in range(len(self)))
+
+    def get_geometry(self, ind):
+        start, end = self.offsets[ind], self.offsets[ind + 1]
+        if start == end:
+            return None
+        return wkb.loads(self.wkb[start:end].tobytes())
+
+def build_shapefile_cache(shp_path, path, checksum):
+    import fiona
+    columns = None
+    buffers = []
+    offsets = [0]
+    with fiona.open(shp_path) as shp:
+        columns = dict([[k, []] for k in shp.schema["properties"].keys()])
+        for feat in shp:
+            for k in columns:
+                columns[k].append(feat["properties"][k])
+            geom = wkb.dumps(shape(feat["geometry"])) if feat["geometry"] is not None else b""
+            buffers.append(geom)
+            offsets.append(offsets[-1] + len(geom))
+    np.save(path + "_wkb.npy", np.frombuffer(b"".join(buffers), dtype = np.uint8))
+    np.save(path + "_offsets.npy", np.array(offsets, dtype = np.int64))
+    with open(path + ".json", "w") as fout:
+        json.dump({
+            "checksum": checksum,
+            "columns": columns
+        }, fout)
+    logging.info("Cached {} features of {} in {}".format(len(offsets) - 1, shp_path, path))
+
+# Opens cached copy of shapefile in cache_dir. Converts shapefile first if there is no cache or it changed.
+def open_shapefile(shp_path, cache_dir):
+    path = os.path.join(cache_dir, os.path.splitext(os.path.basename(shp_path))[0])
+    checksum = get_shapefile_checksum(shp_path)
+    shp = CachedShapefile(path) if os.path.exists(path + ".json") else None
+    if shp == None or shp.checksum != checksum:
+        build_shapefile_cache(shp_path, path, checksum)
+        shp = CachedShapefile(path)
+    return shp
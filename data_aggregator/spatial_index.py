@@ -0,0 +1,55 @@
+from shapely.geometry import Point, box
+from shapely.strtree import STRtree
+from data_aggregator.geometry import check_point_in_polygon, get_distance_from_feature
+
+# R-tree over the features of a GeometryStore. Built once and queried for every coordinate
+class SpatialIndex:
+
+    def __init__(self, store, initial_radius = 1):
+        self.store = store
+        geoms = [store.geometry(ind) for ind in range(len(store))]
+        self.geom_ids = dict([[id(geom), ind] for ind, geom in enumerate(geoms)])
+        self.tree = STRtree(geoms)
+        self.initial_radius = initial_radius
+
+    def __len__(self):
+        return len(self.store)
+
+    # Indices of features whose bounding box intersects geom, in shapefile order
+    def query(self, geom):
+        hits = self.tree.query(geom)
+        # Shapely < 2.0 returns the geometries themselves, >= 2.0 their indices
+        return sorted(self.geom_ids[id(i)] if hasattr(i, "geom_type") else int(i) for i in hits)
+
+    # Index of first feat containing point or None
+    def get_containing(self, lat, lng):
+        for ind in self.query(Point(lng, lat)):
+            if check_point_in_polygon(self.store, ind, lat, lng):
+                return ind
+        return None
+
+    # Index of closest feat. Grows a window around the point until the closest candidate lies within it.
+    # Features outside the window are further than its half width from the point so cannot be closer.
+    def get_nearest(self, lat, lng):
+        radius = self.initial_radius
+        while True:
+            closest_ind = None
+            min_dist = float("Inf")
+            for ind in self.query(box(lng - radius, lat - radius, lng + radius, lat + radius)):
+                dist = get_distance_from_feature(self.store, ind, lat, lng)
+                if dist < min_dist:
+                    closest_ind = ind
+                    min_dist = dist
+            if closest_ind is not None and min_dist <= radius:
+                return closest_ind
+            if radius > 360:    # Window covers every feature
+                return closest_ind
+            radius *= 2
+
+    # Returns index of feat that contains point or closest feat. Matches geometry.get_closest_polygon
+    def get_closest_polygon(self, coords):
+        lat, lng = coords
+        ind = self.get_containing(lat, lng)
+        if ind is None:
+            ind = self.get_nearest(lat, lng)
+        return ind
@@ -1,10 +1,10 @@
 import requests
 import copy
 import numpy as np
-from datetime import timedelta
 from datetime import datetime as dt
 import pandas as pd
 import logging
+from data_aggregator.worker_context import map_with_context
 
 format_id = lambda x: x.replace(" ", "_").replace("&", "_")
 
@@ -19,6 +19,33 @@ def compute_doubling_rate(cases):
     dr = np.round(dr, 3)
     return dr if not np.isposinf(dr) and not np.isneginf(dr) else np.nan
 
+# Doubling rate of the window of width days ending at every day of values (days or locations x days, NaN where there is no data).
+# Same as compute_doubling_rate on the positive values of each window, with the least squares slope from sums of x, y, xy and x^2.
+# x of a positive value is the number of positive values before it in its window
+def compute_doubling_rates(values, width = 5):
+    values = np.asarray(values, dtype = float)
+    one_dim = values.ndim == 1
+    values = np.atleast_2d(values)
+    n = np.zeros(values.shape)
+    sum_y = np.zeros(values.shape)
+    sum_xy = np.zeros(values.shape)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        # Oldest day of the window first
+        for lag in reversed(range(width)):
+            shifted = np.full(values.shape, np.nan)
+            shifted[:, lag:] = values[:, :values.shape[1] - lag]
+            positive = shifted > 0
+            y = np.log(np.where(positive, shifted, 1))
+            sum_y += y
+            sum_xy += n * y
+            n += positive
+        sum_x = n * (n - 1) / 2
+        sum_xx = (n - 1) * n * (2 * n - 1) / 6
+        m = np.round((n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x ** 2), 3)
+        dr = np.where((n > 1) & (m > 0), np.round(np.log(2) / m, 3), np.nan)
+    dr[np.isinf(dr)] = np.nan
+    return dr[0] if one_dim else dr
+
 def compute_days_since(cases, ncases, current_date):
     if cases[cases >= ncases].shape[0] == 0:
         return None
@@ -30,48 +57,169 @@ def compute_days_since(cases, ncases, current_date):
     days_since_ncases = (current_date - first_gte_ncases).days + offset_cases
     return np.round(days_since_ncases, 3)
 
-def compute_stats(item, grp, grouped_sum, iso3, current_date):
-    keys = ["Confirmed", "Recovered", "Deaths"]
-    api_keys = ["confirmed", "recovered", "dead"]
-    sorted_group_sum = grouped_sum.loc[iso3]["Confirmed"].sort_index()
-    item["mostRecent"] = (current_date == sorted_group_sum.index[-1])
+stat_keys = ["Confirmed", "Recovered", "Deaths"]
+stat_api_keys = ["confirmed", "recovered", "dead"]
+
+# values moved n days later in every location (row) of a locations x days array. Days shifted in from outside get fill
+def shift_days(values, n, fill):
+    res = np.full(values.shape, fill, dtype = np.result_type(values, type(fill)))
+    if n >= 0:
+        res[:, n:] = values[:, :values.shape[1] - n]
+    else:
+        res[:, :n] = values[:, -n:]
+    return res
+
+# Sum of the width days ending at every day of a locations x days array
+def rolling_sum_days(values, width):
+    cumsum = np.concatenate([np.zeros((values.shape[0], 1), dtype = values.dtype), np.cumsum(values, axis = 1)], axis = 1)
+    ind = np.arange(values.shape[1])
+    return cumsum[:, ind + 1] - cumsum[:, np.maximum(ind - width + 1, 0)]
+
+# Stats of every (location, date) of grouped_sum from its whole series. Columns are named like item keys and are NaN where compute_stats
+# leaves the key out. Increases and windows count calendar days, so days missing from a series are not bridged.
+def compute_series_stats(grouped_sum, days_since_thresholds = None):
+    if grouped_sum.shape[0] == 0:
+        return pd.DataFrame()
+    keys, location = np.unique(np.asarray(grouped_sum.index.get_level_values(0), dtype = object), return_inverse = True)
+    dates = grouped_sum.index.get_level_values(1)
+    start_date = dates.min()
+    day = (dates - start_date).days.values
+    present = np.zeros((keys.shape[0], day.max() + 1), dtype = bool)
+    present[location, day] = True
+    values = np.full((len(stat_keys), keys.shape[0], day.max() + 1), np.nan)
+    for n, key in enumerate(stat_keys):
+        values[n, location, day] = grouped_sum[key].values
+    return compute_dense_stats(values, present, keys, start_date, stat_keys, grouped_sum.index.names, days_since_thresholds)
+
+# Stats of every location of level name of cube. Counts are read from the cube's metrics x locations x days view, without a copy.
+# With first_days, only rows of location n from day first_days[n] on are returned
+def compute_level_stats(cube, name, days_since_thresholds = None, first_days = None):
+    level = cube.get_level(name)
+    values = cube.get_level_values(name)
+    present = ~np.isnan(values).all(axis = 0)
+    if not present.any():
+        return pd.DataFrame()
+    return compute_dense_stats(values, present, level["keys"], cube.start_date, cube.metrics, [level["key"], "date"], days_since_thresholds, first_days)
+
+# Days before a date whose counts its stats depend on. The rolling mean 14 days ago averages increases from 17 days before, and
+# the increase of a day needs the day before
+STATS_LOOKBACK_DAYS = 18
+
+# Stats of every location that depend on its whole series: its last day with data, the first date with cases and whether
+# the last day increased of every metric, and the day and fractional offset each daysSince threshold was crossed (NaN if never)
+def compute_location_stats(values, present, start_date, metrics, thresholds):
+    ndays = present.shape[1]
+    rows = np.arange(present.shape[0])
+    stats = {}
+    last_day = ndays - 1 - np.argmax(present[:, ::-1], axis = 1)
+    stats["last_day"] = last_day
+    # Second to last day with data of every location, for newToday
+    present_count = np.cumsum(present, axis = 1)
+    prev_last_day = np.argmax(present & (present_count == present_count[:, -1:] - 1), axis = 1)
+    has_prev_last = present_count[:, -1] > 1
     first_date = {}
-    compute_num_increase = lambda x: sorted_group_sum[x] - sorted_group_sum[x - timedelta(days = 1)] if x - timedelta(days = 1) in sorted_group_sum.index else sorted_group_sum[x]
-    for key,api_key in zip(keys, api_keys):
-        sorted_group_sum = grouped_sum.loc[iso3][key].sort_index()
-        item[api_key] = grp[key].sum()
-        # Rolling mean
-        tmp_grp = sorted_group_sum.reset_index()
-        rolling_average = tmp_grp[(tmp_grp["date"]<=(current_date + timedelta(days = 3))) & (tmp_grp["date"] >= current_date - timedelta(days = 3))]["date"].apply(compute_num_increase)
-        # Exclude negative values from lib import funs rolling average
-        rolling_average = rolling_average[rolling_average >= 0].mean()
-        if current_date in sorted_group_sum.index and not np.isnan(rolling_average):
-            item[api_key+"_rolling"] = rolling_average
-        # Compute rolling mean 2 weeks ago
-        rolling_average_14days_ago = tmp_grp[(tmp_grp["date"]<=((current_date - timedelta(days=14)) + timedelta(days = 3))) & (tmp_grp["date"] >= (current_date - timedelta(days=14)) - timedelta(days = 3))]["date"].apply(compute_num_increase)
-        rolling_average_14days_ago = rolling_average_14days_ago[rolling_average_14days_ago >= 0].mean() if rolling_average_14days_ago.shape[0] > 0 else np.nan
-        if current_date in sorted_group_sum.index and not np.isnan(rolling_average_14days_ago):
-            item[api_key+"_rolling_14days_ago"] = rolling_average_14days_ago
-            if api_key + "_rolling" in item:
-                item[api_key+"_rolling_14days_ago_diff"] = rolling_average - rolling_average_14days_ago
-        # Doubling rate
-        val_dr = tmp_grp[(tmp_grp["date"]<= current_date) & (tmp_grp["date"] >= current_date - timedelta(days = 4))][key].tolist()
-        val_dr = [i for i in val_dr if i > 0]
-        dr = compute_doubling_rate(val_dr) if len(val_dr) > 1 else np.nan
-        if current_date in sorted_group_sum.index and not np.isnan(dr):
-            item[api_key+"_doublingRate"] = dr
-        # item[api_key+"_currentCases"] = sorted_group_sum.iloc[-1]
-        # item[api_key+"_currentIncrease"] = sorted_group_sum.iloc[-1] - sorted_group_sum.iloc[-2] if len(sorted_group_sum) > 1 else sorted_group_sum.iloc[-1]
-        # if len(sorted_group_sum) > 1 and sorted_group_sum.iloc[-2] !=0:
-        #     item[api_key+"_currentPctIncrease"] = ((sorted_group_sum.iloc[-1] - sorted_group_sum.iloc[-2])/sorted_group_sum.iloc[-2])
-        # item[api_key+"_currentToday"] = sorted_group_sum.index[-1].strftime("%Y-%m-%d")
-        first_date[key] = sorted_group_sum[sorted_group_sum > 0].index[0] if sorted_group_sum[sorted_group_sum > 0].shape[0] > 0 else ""
-        item[api_key+"_firstDate"] = first_date[key].strftime("%Y-%m-%d") if first_date[key] != "" else ""
-        item[api_key+"_newToday"] = True if len(sorted_group_sum) > 1 and sorted_group_sum.iloc[-1] - sorted_group_sum.iloc[-2] > 0 else False
-        item[api_key+"_numIncrease"] = compute_num_increase(current_date)
+    for key, api_key in zip(stat_keys, stat_api_keys):
+        series = np.asarray(values[metrics.index(key)], dtype = float)
+        positive = present & (series > 0)
+        first_date[key] = pd.Series(np.where(positive.any(axis = 1), np.argmax(positive, axis = 1), np.nan))
+        first_date_str = (start_date + pd.to_timedelta(first_date[key], unit = "D")).dt.strftime("%Y-%m-%d").values
+        stats[api_key + "_firstDate"] = np.where(first_date[key].isna().values, "", first_date_str)
+        with np.errstate(invalid = "ignore"):
+            stats[api_key + "_newToday"] = has_prev_last & (series[rows, last_day] - series[rows, prev_last_day] > 0)
+    stats["first_dead-first_confirmed"] = (first_date["Deaths"] - first_date["Confirmed"]).values
+    # Crossing of each threshold is found once per location from the counts of its present days
+    stats["crossings"] = {}
+    for name, key, ncases in thresholds:
+        counts = np.asarray(values[metrics.index(key)], dtype = float)
+        crossing_day = np.full(present.shape[0], np.nan)
+        crossing_offset = np.full(present.shape[0], np.nan)
+        for n in rows:
+            days = np.nonzero(present[n])[0]
+            crossing = get_threshold_crossing(counts[n, days], ncases)
+            if crossing != None:
+                crossing_day[n] = days[crossing[0]]
+                crossing_offset[n] = crossing[1]
+        stats["crossings"][name] = [crossing_day, crossing_offset]
+    return stats
 
-        if current_date - timedelta(days = 1) in sorted_group_sum.index and sorted_group_sum[current_date - timedelta(days = 1)] > 0:
-            item[api_key+"_pctIncrease"] = (sorted_group_sum[current_date] - sorted_group_sum[current_date - timedelta(days = 1)])/sorted_group_sum[current_date - timedelta(days = 1)]
+# Stats from values, metrics x locations x days of counts from start_date, where present marks the days a location has data.
+# Returns rows of the present days indexed by (key, date), in order of keys and dates. With first_days, only rows of location n
+# from day first_days[n] on are returned and per date stats are computed from STATS_LOOKBACK_DAYS before the earliest of them
+def compute_dense_stats(values, present, keys, start_date, metrics, names, days_since_thresholds = None, first_days = None):
+    thresholds = days_since_thresholds if days_since_thresholds != None else get_days_since_thresholds()
+    location_stats = compute_location_stats(values, present, start_date, metrics, thresholds)
+    start = 0
+    rows = present
+    if first_days is not None:
+        start = max(int(np.min(first_days)) - STATS_LOOKBACK_DAYS, 0) if len(first_days) > 0 else 0
+        rows = present & (np.arange(present.shape[1]) >= np.asarray(first_days)[:, None])
+    present = present[:, start:]
+    location, day = np.nonzero(rows[:, start:])
+    stats = {}
+    stats["mostRecent"] = day + start == location_stats["last_day"][location]
+    prev_present = shift_days(present, 1, False)
+    for key, api_key in zip(stat_keys, stat_api_keys):
+        series = np.asarray(values[metrics.index(key)][:, start:], dtype = float)
+        prev = shift_days(series, 1, np.nan)
+        increase = np.where(prev_present, series - prev, series)
+        increase[~present] = np.nan
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            # Rolling mean of non negative increases in [date - 3, date + 3]. 14 days ago is the same window around date - 14
+            # Windows are padded by 3 days without data so that windows around the last days extend past the last day
+            valid = np.pad(present & (increase >= 0), [[0, 0], [0, 3]], "constant")
+            window_sum = rolling_sum_days(np.where(valid, np.pad(increase, [[0, 0], [0, 3]], "constant"), 0), 7)
+            window_count = rolling_sum_days(valid.astype(np.int64), 7)
+            window_mean = np.where(window_count > 0, window_sum / np.maximum(window_count, 1), np.nan)
+            rolling = shift_days(window_mean, -3, np.nan)[location, day]
+            rolling_14days_ago = shift_days(window_mean, 11, np.nan)[location, day]
+            stats[api_key] = series[location, day]
+            stats[api_key + "_rolling"] = rolling
+            stats[api_key + "_rolling_14days_ago"] = rolling_14days_ago
+            stats[api_key + "_rolling_14days_ago_diff"] = rolling - rolling_14days_ago
+            stats[api_key + "_numIncrease"] = increase[location, day]
+            stats[api_key + "_pctIncrease"] = np.where(prev_present & (prev > 0), (series - prev) / prev, np.nan)[location, day]
+        stats[api_key + "_doublingRate"] = compute_doubling_rates(np.where(present, series, np.nan))[location, day]
+        # First date with cases and whether the last day of the series increased apply to every date of a location
+        stats[api_key + "_firstDate"] = location_stats[api_key + "_firstDate"][location]
+        stats[api_key + "_newToday"] = location_stats[api_key + "_newToday"][location]
+    stats["first_dead-first_confirmed"] = location_stats["first_dead-first_confirmed"][location]
+    # daysSince of every date is its distance from the day its location crossed the threshold
+    for name, key, ncases in thresholds:
+        crossing_day, crossing_offset = location_stats["crossings"][name]
+        stats[name] = np.round(day + start - crossing_day[location] + crossing_offset[location], 3)
+    index = pd.MultiIndex.from_arrays([
+        np.asarray(keys, dtype = object)[location],
+        start_date + pd.to_timedelta(day + start, unit = "D")
+    ], names = names)
+    return pd.DataFrame(stats, index = index)
+
+# Item key, column and threshold of every daysSince stat
+def get_days_since_thresholds(cases = [100], deaths = [10, 50]):
+    return [["daysSince{}Cases".format(n), "Confirmed", n] for n in cases] + [["daysSince{}Deaths".format(n), "Deaths", n] for n in deaths]
+
+# Fractional day on which cases first reached ncases, as an offset from the first date of cases. None if it never
+# crossed, like compute_days_since. Running max and suffix min are sorted so the crossing is found with searchsorted.
+def get_threshold_crossing(cases, ncases):
+    first_gte = np.searchsorted(np.maximum.accumulate(cases), ncases, side = "left")
+    last_lt = np.searchsorted(np.minimum.accumulate(cases[::-1])[::-1], ncases, side = "left") - 1
+    if first_gte == cases.shape[0] or last_lt < 0:
+        return None
+    offset_cases = 1 - ((ncases - cases[last_lt])/(cases[first_gte] - cases[last_lt]))
+    return first_gte, offset_cases
+
+# Copies stats, the row of compute_series_stats for the item's location and date, to item
+def compute_stats(item, stats):
+    item["mostRecent"] = bool(stats["mostRecent"])
+    for api_key in stat_api_keys:
+        item[api_key] = stats[api_key]
+        for k in [api_key + "_rolling", api_key + "_rolling_14days_ago", api_key + "_rolling_14days_ago_diff", api_key + "_doublingRate"]:
+            if not pd.isna(stats[k]):
+                item[k] = stats[k]
+        item[api_key+"_firstDate"] = stats[api_key+"_firstDate"]
+        item[api_key+"_newToday"] = bool(stats[api_key+"_newToday"])
+        item[api_key+"_numIncrease"] = stats[api_key+"_numIncrease"]
+        if not pd.isna(stats[api_key+"_pctIncrease"]):
+            item[api_key+"_pctIncrease"] = stats[api_key+"_pctIncrease"]
 
         if "population" in item and item["population"] > 0:
             per_capita_keys = [api_key, api_key+"_rolling", api_key+"_rolling_14days_ago", api_key+"_rolling_14days_ago_diff"]
@@ -79,163 +227,170 @@ def compute_stats(item, grp, grouped_sum, iso3, current_date):
                 if per_capita_key not in item:
                     continue
                 item[per_capita_key+"_per_100k"] = (item[per_capita_key]/item["population"]) * 100000
-    if first_date["Confirmed"] != "" and first_date["Deaths"] != "":
-        item["first_dead-first_confirmed"] = (first_date["Deaths"] - first_date["Confirmed"]).days
-    # daysSince100Cases
-    confirmed_cases = grouped_sum.loc[iso3]["Confirmed"].sort_index()
-    days_since_100_cases = compute_days_since(confirmed_cases, 100, current_date)
-    if days_since_100_cases != None and days_since_100_cases >= 0:
-        item["daysSince100Cases"] = days_since_100_cases
-    # daysSince10Deaths
-    deaths = grouped_sum.loc[iso3]["Deaths"].sort_index()
-    days_since_10_deaths = compute_days_since(deaths, 10, current_date)
-    if days_since_10_deaths != None and days_since_10_deaths >= 0:
-        item["daysSince10Deaths"] = days_since_10_deaths
-    # daysSince50Deaths
-    deaths = grouped_sum.loc[iso3]["Deaths"].sort_index()
-    days_since_50_deaths = compute_days_since(deaths, 50, current_date)
-    if days_since_50_deaths != None and days_since_50_deaths>=0:
-        item["daysSince50Deaths"] = days_since_50_deaths
+    if not pd.isna(stats["first_dead-first_confirmed"]):
+        item["first_dead-first_confirmed"] = int(stats["first_dead-first_confirmed"])
+    for k in [i for i in stats.index if i.startswith("daysSince")]:
+        if not pd.isna(stats[k]) and stats[k] >= 0:
+            item[k] = stats[k]
+
+# Sets the stats of item that are the same on every date of its location from stats, like compute_stats
+def update_location_stats(item, stats):
+    for api_key in stat_api_keys:
+        item[api_key+"_firstDate"] = stats[api_key+"_firstDate"]
+        item[api_key+"_newToday"] = bool(stats[api_key+"_newToday"])
+    if not pd.isna(stats["first_dead-first_confirmed"]):
+        item["first_dead-first_confirmed"] = int(stats["first_dead-first_confirmed"])
+    elif "first_dead-first_confirmed" in item:
+        del item["first_dead-first_confirmed"]
+
+# Items of every date of the locations in keys. generate_item is called with each (key, date) and its row of series_stats,
+# which is sliced once per location
+def generate_location_items(keys, generate_item, series_stats, **context):
+    items = []
+    for key in keys:
+        for current_date, stats in series_stats.loc[key].iterrows():
+            items.append(generate_item((key, current_date), stats, **context))
+    return items
+
+# Items of every (location, date) of series_stats on nprocess workers. Each task generates all items of chunksize locations
+def generate_level_items(generate_item, series_stats, context, nprocess, name, chunksize):
+    keys = list(series_stats.index.get_level_values(0).unique())
+    batches = [keys[i:i + chunksize] for i in range(0, len(keys), chunksize)]
+    context = dict(context, generate_item = generate_item, series_stats = series_stats)
+    return [item for items in map_with_context(generate_location_items, batches, context, nprocess, name) for item in items]
 
 # Extract metropolitan area features
-def get_metro_feat(cbsa, shp):
-    feats = [i for i in shp if i["properties"]["CBSAFP"] == cbsa]
-    if len(feats) == 0:
+def get_metro_feat(cbsa, store):
+    ind = store.lookup(cbsa)
+    if ind == None:
         logging.info("Couldn't find metro feature for CBSA code: {}".format(cbsa))
-        return None
-    return feats[0]
+    return ind
 
 # Countries
-def generate_country_item(ind_grp, grouped_sum, country_sub_national):
-    (ind, grp) = ind_grp
+def generate_country_item(ind, stats, country_sub_national, locations):
+    loc = locations.loc[ind[0]]
     item = {
         "date": ind[1].strftime("%Y-%m-%d"),
-        "name": grp["computed_country_name"].iloc[0],
-        "country_name": grp["computed_country_name"].iloc[0],
-        "iso3": grp["computed_country_iso3"].iloc[0],
-        "lat": grp["Lat"].iloc[0],
-        "long": grp["Long"].iloc[0],
-        "population": grp["computed_country_pop"].iloc[0],
-        "wb_region": grp["computed_region_wb"].iloc[0],
-        "location_id" : format_id(grp["computed_country_iso3"].iloc[0]),
-        "_id": format_id(grp["computed_country_iso3"].iloc[0] + "_" + ind[1].strftime("%Y-%m-%d")),
+        "name": loc["computed_country_name"],
+        "country_name": loc["computed_country_name"],
+        "iso3": ind[0],
+        "population": loc["computed_country_pop"],
+        "wb_region": loc["computed_region_wb"],
+        "location_id" : format_id(ind[0]),
+        "_id": format_id(ind[0] + "_" + ind[1].strftime("%Y-%m-%d")),
         "admin_level": 0,
-        "lat": grp["computed_country_lat"].iloc[0],
-        "long": grp["computed_country_long"].iloc[0],
+        "lat": loc["computed_country_lat"],
+        "long": loc["computed_country_long"],
         "num_subnational": int(country_sub_national[ind[0]]),
-        "gdp_last_updated":grp["gdp_update_year"].iloc[0],
-        "gdp_per_capita":grp["country_gdp"].iloc[0]  # For every date number of admin1 regions in country with reported cases.
+        "gdp_last_updated":loc["gdp_update_year"],
+        "gdp_per_capita":loc["country_gdp"]  # For every date number of admin1 regions in country with reported cases.
     }
-    compute_stats(item, grp, grouped_sum, ind[0], ind[1])
+    compute_stats(item, stats)
     return item
 
-# States
-def generate_state_item(ind_grp, grouped_sum, testing_columns):
-    ind,grp = ind_grp
+# States. testing has the testing columns of the first row of every (state, date)
+def generate_state_item(ind, stats, testing, locations):
+    loc = locations.loc[ind[0]]
     item = {
         "date": ind[1].strftime("%Y-%m-%d"),
-        "name": grp["computed_state_name"].iloc[0],
-        "country_name": grp["computed_country_name"].iloc[0],
-        "iso3": grp["computed_state_iso3"].iloc[0],
-        "country_iso3": grp["computed_country_iso3"].iloc[0],
-        "lat": grp["Lat"].iloc[0],
-        "long": grp["Long"].iloc[0],
-        "country_population": grp["computed_country_pop"].iloc[0],
-        "wb_region": grp["computed_region_wb"].iloc[0],
-        "location_id" : format_id(grp["computed_country_iso3"].iloc[0] +"_" + grp["computed_state_iso3"].iloc[0]),
-        "_id": format_id(grp["computed_country_iso3"].iloc[0] +"_" + grp["computed_state_iso3"].iloc[0] + "_" + ind[1].strftime("%Y-%m-%d")),
+        "name": loc["computed_state_name"],
+        "country_name": loc["computed_country_name"],
+        "iso3": ind[0],
+        "country_iso3": loc["computed_country_iso3"],
+        "country_population": loc["computed_country_pop"],
+        "wb_region": loc["computed_region_wb"],
+        "location_id" : format_id(loc["computed_country_iso3"] +"_" + ind[0]),
+        "_id": format_id(loc["computed_country_iso3"] +"_" + ind[0] + "_" + ind[1].strftime("%Y-%m-%d")),
         "admin_level": 1,
-        "lat": grp["computed_state_lat"].iloc[0],
-        "long": grp["computed_state_long"].iloc[0],
-        "gdp_last_updated":grp["gdp_update_year"].iloc[0],
-        "country_gdp_per_capita":grp["country_gdp"].iloc[0]
+        "lat": loc["computed_state_lat"],
+        "long": loc["computed_state_long"],
+        "gdp_last_updated":loc["gdp_update_year"],
+        "country_gdp_per_capita":loc["country_gdp"]
     }
-    if grp["computed_country_iso3"].iloc[0] == "USA":
-        for i in testing_columns:
-            if pd.isna(grp[i].iloc[0]):
+    if loc["computed_country_iso3"] == "USA":
+        tests = testing.loc[ind]
+        for i in testing.columns:
+            if pd.isna(tests[i]):
                 continue
-            item[i] = grp[i].iloc[0]
-        pop = grp["computed_state_pop"].iloc[0]
+            item[i] = tests[i]
+        pop = loc["computed_state_pop"]
         if not pd.isna(pop) and pop > 0:
             item["population"] = pop
             # Compute case stats
-    compute_stats(item, grp, grouped_sum, ind[0], ind[1])
+    compute_stats(item, stats)
     return item
 
 # Counties
-def generate_county_item(ind_grp, grouped_sum):
-    ind,grp = ind_grp
+def generate_county_item(ind, stats, locations):
+    loc = locations.loc[ind[0]]
     item = {
         "date": ind[1].strftime("%Y-%m-%d"),
-        "name": grp["computed_county_name"].iloc[0],
-        "iso3": grp["computed_county_iso3"].iloc[0],
-        "state_name": grp["computed_state_name"].iloc[0],
-        "country_name": grp["computed_country_name"].iloc[0],
-        "state_iso3": grp["computed_state_iso3"].iloc[0],
-        "country_iso3": grp["computed_country_iso3"].iloc[0],
-        "lat": grp["Lat"].iloc[0],
-        "long": grp["Long"].iloc[0],
-        "country_population": grp["computed_country_pop"].iloc[0],
-        "wb_region": grp["computed_region_wb"].iloc[0],
-        "location_id" : format_id(grp["computed_country_iso3"].iloc[0] +"_" + grp["computed_state_iso3"].iloc[0] + "_" + grp["computed_county_iso3"].iloc[0]),
-        "_id": format_id(grp["computed_country_iso3"].iloc[0] +"_" + grp["computed_state_iso3"].iloc[0] + "_" + grp["computed_county_iso3"].iloc[0] + "_" + ind[1].strftime("%Y-%m-%d")),
+        "name": loc["computed_county_name"],
+        "iso3": ind[0],
+        "state_name": loc["computed_state_name"],
+        "country_name": loc["computed_country_name"],
+        "state_iso3": loc["computed_state_iso3"],
+        "country_iso3": loc["computed_country_iso3"],
+        "country_population": loc["computed_country_pop"],
+        "wb_region": loc["computed_region_wb"],
+        "location_id" : format_id(loc["computed_country_iso3"] +"_" + loc["computed_state_iso3"] + "_" + ind[0]),
+        "_id": format_id(loc["computed_country_iso3"] +"_" + loc["computed_state_iso3"] + "_" + ind[0] + "_" + ind[1].strftime("%Y-%m-%d")),
         "admin_level": 2,
-        "lat": grp["computed_county_lat"].iloc[0],
-        "long": grp["computed_county_long"].iloc[0],
-        "gdp_last_updated":grp["gdp_update_year"].iloc[0],
-        "country_gdp_per_capita":grp["country_gdp"].iloc[0]
+        "lat": loc["computed_county_lat"],
+        "long": loc["computed_county_long"],
+        "gdp_last_updated":loc["gdp_update_year"],
+        "country_gdp_per_capita":loc["country_gdp"]
     }
-    pop = grp["computed_county_pop"].iloc[0]
-    state_pop = grp["computed_state_pop"].iloc[0]
+    pop = loc["computed_county_pop"]
+    state_pop = loc["computed_state_pop"]
     if not pd.isna(pop) and pop > 0:
         item["population"] = pop
     if not pd.isna(state_pop) and pop > 0:
         item["state_population"] = state_pop
-    compute_stats(item, grp, grouped_sum, ind[0], ind[1])
+    compute_stats(item, stats)
     return item
 
 # wb_region
-def generate_region_item(ind_grp, grouped_sum):
-    ind,grp = ind_grp
+def generate_region_item(ind, stats):
     item = {
         "date": ind[1].strftime("%Y-%m-%d"),
-        "name": grp["computed_region_wb"].iloc[0],
-        "iso3": grp["computed_region_wb"].iloc[0],
-        "wb_region": grp["computed_region_wb"].iloc[0],
-        "location_id" : format_id(grp["computed_region_wb"].iloc[0]),
-        "_id": format_id(grp["computed_region_wb"].iloc[0] + "_" + ind[1].strftime("%Y-%m-%d")),
+        "name": ind[0],
+        "iso3": ind[0],
+        "wb_region": ind[0],
+        "location_id" : format_id(ind[0]),
+        "_id": format_id(ind[0] + "_" + ind[1].strftime("%Y-%m-%d")),
         "admin_level": -1
     }
-    compute_stats(item, grp, grouped_sum, ind[0], ind[1])
+    compute_stats(item, stats)
     return item
 
 # metropolitan areas
-def generate_metro_item(ind_grp, grouped_sum, metro):
-    ind,grp = ind_grp
+def generate_metro_item(ind, stats, metro, locations):
+    loc = locations.loc[ind[0]]
     get_metro_counties = lambda x: metro[metro["CBSA Code"] == x][["County/County Equivalent", "State Name", "fips"]].rename(columns={"County/County Equivalent": "county_name", "State Name": "state_name"}).to_dict("records")
     item = {
         "date": ind[1].strftime("%Y-%m-%d"),
-        "name": grp["computed_metro_name"].iloc[0],
-        "cbsa": grp["computed_metro_cbsa"].iloc[0],
-        "lat": grp["computed_metro_lat"].iloc[0],
-        "long": grp["computed_metro_long"].iloc[0],
-        "location_id" : format_id("METRO_"+grp["computed_metro_cbsa"].iloc[0]),
-        "_id": format_id("METRO_"+grp["computed_metro_cbsa"].iloc[0] + "_" + ind[1].strftime("%Y-%m-%d")),
+        "name": loc["computed_metro_name"],
+        "cbsa": ind[0],
+        "lat": loc["computed_metro_lat"],
+        "long": loc["computed_metro_long"],
+        "location_id" : format_id("METRO_"+ind[0]),
+        "_id": format_id("METRO_"+ind[0] + "_" + ind[1].strftime("%Y-%m-%d")),
         "admin_level": 1.5,
-        "country_name": grp["computed_country_name"].iloc[0],
-        "sub_parts": get_metro_counties(grp["CBSA_Code"].iloc[0]),
-        "wb_region": grp["computed_region_wb"].iloc[0]
+        "country_name": loc["computed_country_name"],
+        "sub_parts": get_metro_counties(ind[0]),
+        "wb_region": loc["computed_region_wb"]
     }
-    pop = grp["computed_metro_pop"].iloc[0]
+    pop = loc["computed_metro_pop"]
     if not pd.isna(pop) and pop > 0:
         item["population"] = pop
-    compute_stats(item, grp, grouped_sum, ind[0], ind[1])
+    compute_stats(item, stats)
     return item
 
 # Add testing data
-def get_us_testing_data(admn1_shp):
+def get_us_testing_data(admn1_store):
     testing_api_url = "https://covidtracking.com/api/states/daily"
-    us_states = [i for i in admn1_shp if i["properties"]["adm0_a3"] == "USA"]
+    us_states = [i for i in admn1_store.properties if i["adm0_a3"] == "USA"]
     resp = requests.get(testing_api_url)
     us_testing = {}
     if resp.status_code != 200:
@@ -243,7 +398,7 @@ def get_us_testing_data(admn1_shp):
         return us_testing
     testing = resp.json()
     for feat in us_states:
-        state_tests = [i for i in testing if i["state"] == feat["properties"]["i_3166_"][-2:]]
+        state_tests = [i for i in testing if i["state"] == feat["i_3166_"][-2:]]
         if len(state_tests) > 0:
             for state_test in state_tests:
                 d = {}
@@ -257,67 +412,7 @@ def get_us_testing_data(admn1_shp):
                     if k  == "date":
                         current_date = dt.strptime(str(v), "%Y%m%d").strftime("%Y-%m-%d")
                     d[k] = v
-                us_testing[current_date + "_" + feat["properties"]["i_3166_"]] = copy.deepcopy(d)
+                us_testing[current_date + "_" + feat["i_3166_"]] = copy.deepcopy(d)
         else:
-            logging.warning("No testing data for US State: {}".format(feat["properties"]["iso_3166_"]))
+            logging.warning("No testing data for US State: {}".format(feat["i_3166_"]))
     return us_testing
-
-def populate_country(x):
-    country_attr = {
-        "computed_country_name": "NAME",
-        "computed_country_pop": "POP_EST",
-        "computed_country_iso3": "ADM0_A3"
-    }
-    centroid = get_centroid(usa_country_feat["geometry"]) if x["Country_Region"] == "USA_NYT" else get_centroid(country_feats[(x["Lat"], x["Long"])]["geometry"])
-    get_val = lambda x,v: usa_country_feat["properties"][v] if x["Country_Region"] == "USA_NYT" else country_feats[(x["Lat"], x["Long"])]["properties"][v]
-    attr = dict([[k, get_val(x,v)] for k,v in country_attr.items()])
-    attr.update({
-        "computed_region_wb": country_feats[(x["Lat"], x["Long"])]["properties"]["REGION_WB"] + ": China" if x["computed_country_iso3"] == "CHN" else usa_country_feat["properties"]["REGION_WB"] if x["Country_Region"] == "USA_NYT" else country_feats[(x["Lat"], x["Long"])]["properties"]["REGION_WB"],
-        "computed_country_long": centroid[0],
-        "computed_country_lat": centroid[1]
-    })
-    return pd.Series(attr)
-
-def populate_state(x):
-    centroid = get_centroid(us_state_feats[x["fips"][:2]]["geometry"])
-    attr = {
-        "computed_state_long": centroid[0],
-        "computed_state_lat": centroid[1],
-        "computed_state_name": us_state_feats[x["fips"][:2]]["properties"]["name"],
-        "computed_state_iso3": us_state_feats[x["fips"][:2]]["properties"]["i_3166_"],
-        "computed_state_pop": us_state_feats[x["fips"][:2]]["properties"]["POPESTI"]
-    }
-    return pd.Series(attr)
-
-def populate_non_us_state(x):
-    cetroid = get_centroid(state_feats[(x["Lat"], x["Long"])]["geometry"])
-    attr = {
-        "computed_state_long": centroid[0],
-        "computed_state_lat": centroid[1],
-        "computed_state_name": state_feats[(x["Lat"], x["Long"])]["properties"]["name"],
-        "computed_state_iso3": state_feats[(x["Lat"], x["Long"])]["properties"]["i_3166_"]
-    }
-    return pd.Series(attr)
-
-
-def populate_us_county(x):
-    cetroid = get_centroid(usa_admn2_feats[x["fips"]]["geometry"])
-    attr = {
-        "computed_county_long": centroid[0],
-        "computed_county_lat": centroid[1],
-        "computed_county_name": usa_admn2_feats[x["fips"]]["properties"]["NAMELSA"],
-        "computed_county_iso3": usa_admn2_feats[x["fips"]]["properties"]["STATEFP"] + usa_admn2_feats[x["fips"]]["properties"]["COUNTYF"],
-        "computed_county_pop": usa_admn2_feats[x["fips"]]["properties"]["POPESTI"]
-    }
-    return pd.Series(attr)
-
-def populate_us_metro(x):
-    centroid = get_centroid(metro_feats[x["CBSA_Code"]]["geometry"]) if metro_feats[x["CBSA_Code"]] != None else [None, None]
-    attr = {
-        "computed_metro_long": centroid[0],
-        "computed_metro_lat": centroid[1],
-        "computed_metro_cbsa": metro_feats[x["CBSA_Code"]]["properties"]["CBSAFP"] if metro_feats[x["CBSA_Code"]] != None else None,
-        "computed_metro_name": metro_feats[x["CBSA_Code"]]["properties"]["NAME"] if metro_feats[x["CBSA_Code"]] != None else None,
-        "computed_metro_pop": metro_feats[x["CBSA_Code"]]["properties"]["POPESTI"] if metro_feats[x["CBSA_Code"]] != None else None
-    }
-    return pd.Series(attr)
@@ -0,0 +1,38 @@
+import pickle
+import logging
+import multiprocessing
+import sys
+import numpy as np
+from data_aggregator.frame import format_bytes
+
+# Read only structures shared by every task of a pool. Set once per worker by init_worker_context
+_context = {}
+
+# Pool initializer. With fork the context is inherited by the workers and not pickled at all, with spawn it is pickled once per worker
+def init_worker_context(context):
+    _context.clear()
+    _context.update(context)
+
+def call_with_context(func, key):
+    return func(key, **_context)
+
+def get_pickled_size(obj):
+    return len(pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL))
+
+# In memory size of the frames of context. Estimates what pickling context would cost without serializing it in the parent
+def get_context_size(context):
+    return sum(int(np.sum(v.memory_usage(deep = True))) if hasattr(v, "memory_usage") else sys.getsizeof(v) for v in context.values())
+
+# Calls func(key, **context) for every key on nprocess workers. Only func's name and the key are pickled with each task.
+# Logs bytes pickled for the tasks against sending context with every task as before, from the estimated size of context
+def map_with_context(func, keys, context, nprocess, name):
+    tasks = [(func, key) for key in keys]
+    task_bytes = get_pickled_size(tasks)
+    context_bytes = get_context_size(context)
+    with multiprocessing.Pool(processes = nprocess, initializer = init_worker_context, initargs = (context,)) as pool:
+        res = pool.starmap(call_with_context, tasks)
+        pool.close()
+        pool.join()
+    logging.info("{} tasks: {} pickled for {} tasks and about {} of context at most once per worker, instead of about {} with context in every task".format(
+        name, format_bytes(task_bytes), len(tasks), format_bytes(context_bytes), format_bytes(task_bytes + context_bytes * len(tasks))))
+    return res
@@ -111,6 +111,8 @@ def aggregate_states(orig_df, admn0_shp, admn1_shp, feats = []):
     excluded_countries = ["UNK", "FRA", "DNK"]
     df_states["feats"] = df_states[["Lat", "Long"]].apply(lambda x: get_closest_polygon(admn1_shp, x["Lat"], x["Long"]), axis = 1) if len(feats) == 0 else feats
     df_states["computed_state"] = df_states["feats"].apply(lambda i: i["properties"]["iso_3166_2"]+ "_" + i["properties"]["adm0_a3"])
+    # Country population by ADM0_A3 in one pass over admn0_shp
+    country_pop = dict([[i["properties"]["ADM0_A3"], i["properties"]["POP_EST"]] for i in reversed(list(admn0_shp))])
     states = []
     for n, grp in df_states.groupby("computed_state"):
         grp_lat_lng = grp.iloc[0][grp.columns[2:4]]
@@ -127,8 +129,7 @@ def aggregate_states(orig_df, admn0_shp, admn1_shp, feats = []):
         row["location_id"] = n
         row["country_iso3"] = admin1_feature["properties"]["adm0_a3"]
         row["country_name"] = admin1_feature["properties"]["admin"]
-        country_pop = [i["properties"]["POP_EST"] for i in admn0_shp if i["properties"]["ADM0_A3"] == row["country_iso3"]][0]
-        row["country_population"] = country_pop
+        row["country_population"] = country_pop[row["country_iso3"]]
         geom = admin1_feature["geometry"]
         centroid = get_centroid(geom)
         row["lat"] = centroid[1]
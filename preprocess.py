@@ -2,7 +2,6 @@ import pandas as pd
 import os
 from datetime import datetime as dt
 from datetime import timedelta
-import fiona
 from shapely.geometry import shape, Point, LinearRing
 import multiprocessing
 from itertools import repeat
@@ -13,6 +12,10 @@ import re
 import requests
 import copy
 import configparser
+from data_aggregator.geometry import GeometryStore, index_features, get_admn0_key, get_admn1_key, get_admn2_key, get_metro_key, get_state_fips_key
+from data_aggregator.spatial_index import SpatialIndex
+from data_aggregator.shapefile_cache import open_shapefile
+from data_aggregator.daily_report import set_modal_lat_long
 
 # Get paths
 config = configparser.ConfigParser()
@@ -41,17 +44,21 @@ out_json_path = config["output"]["out_json_path"]
 # Processes
 nprocess = int(config["process"]["nprocess"])
 
+# Cache
+cache_dir = config.get("cache", "cache_dir", fallback = os.path.join(os.path.dirname(export_df_path), "cache"))
+os.makedirs(cache_dir, exist_ok = True)
+
 # Simplified geoJSON
 simplified_admn0_path = config["simplified_shapefiles"]["admn0_path"]
 simplified_admn1_path = config["simplified_shapefiles"]["admn1_path"]
 simplified_admn2_path = config["simplified_shapefiles"]["admn2_path"]
 simplified_usa_metro_path = config["simplified_shapefiles"]["usa_metro_path"]
 
-# Read shapefiles
-admn0_shp = fiona.open(admn0_path)
-admn1_shp = fiona.open(admn1_path)
-usa_admn2_shp = fiona.open(admn2_path)
-usa_metro_shp = fiona.open(usa_metro_path)
+# Read shapefiles from binary cache. Geometries are decoded only when first used
+admn0_shp = open_shapefile(admn0_path, cache_dir)
+admn1_shp = open_shapefile(admn1_path, cache_dir)
+usa_admn2_shp = open_shapefile(admn2_path, cache_dir)
+usa_metro_shp = open_shapefile(usa_metro_path, cache_dir)
 
 # Return centroid of polygon or largest polygon in set
 def get_centroid(geom):
@@ -215,17 +222,9 @@ print("\n".join([str(i) for i in daily_df[daily_df["Lat"].isna()]["Country_Regio
 daily_df = daily_df[~daily_df["Lat"].isna()]
 
 # Set lat long to the most frequent used values. To deal with cases like French Polynesia
-for i, grp in daily_df[daily_df["Province_State"].isna() & daily_df["Admin2"].isna()].groupby("Country_Region"):
-    daily_df.loc[(daily_df["Country_Region"] == i) & daily_df["Province_State"].isna() & daily_df["Admin2"].isna(), "Lat"] = grp["Lat"].dropna().mode().values[0]
-    daily_df.loc[(daily_df["Country_Region"] == i) & daily_df["Province_State"].isna() & daily_df["Admin2"].isna(), "Long"] = grp["Long"].dropna().mode().values[0]
-
-for i, grp in daily_df[daily_df["Admin2"].isna()].groupby(["Country_Region", "Province_State"]):
-    daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & daily_df["Admin2"].isna(), "Lat"] = grp["Lat"].dropna().mode().values[0]
-    daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & daily_df["Admin2"].isna(), "Long"] = grp["Long"].dropna().mode().values[0]
-
-for i, grp in daily_df.groupby(["Country_Region", "Province_State", "Admin2"]):
-    daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & (daily_df["Admin2"] == i[2]), "Lat"] = grp["Lat"].dropna().mode().values[0]
-    daily_df.loc[(daily_df["Country_Region"] == i[0]) & (daily_df["Province_State"] == i[1]) & (daily_df["Admin2"] == i[2]), "Long"] = grp["Long"].dropna().mode().values[0]
+set_modal_lat_long(daily_df, ["Country_Region"], daily_df["Province_State"].isna() & daily_df["Admin2"].isna())
+set_modal_lat_long(daily_df, ["Country_Region", "Province_State"], daily_df["Admin2"].isna())
+set_modal_lat_long(daily_df, ["Country_Region", "Province_State", "Admin2"])
 
 # Round Lat Long to 4 decimal places
 daily_df["Lat"] = daily_df["Lat"].round(6)
@@ -241,42 +240,31 @@ nyt_state = pd.read_csv(nyt_state_path, dtype = {
     "fips": str
 })
 
-# Map territory fips to adm0_a3 code
-fips_iso3 = {
-    "VIR": "52",
-    "GUM": "66",
-    "MNP": "69",
-    "VIR": "78",
-    "PRI": "72",
-    "ASM": "60"
-}
-
-# Extract matching features from NE shapefiles
-usa_admn1_shp = [i for i in admn1_shp if i["properties"]["adm0_a3"] in fips_iso3.keys() or i["properties"]["adm0_a3"] == "USA"]
+# Extract matching features from NE shapefiles. Keyed indexes are built in one pass over each shapefile
+admn0_by_iso3 = index_features(admn0_shp, get_admn0_key)
+admn1_by_iso3 = index_features(admn1_shp, get_admn1_key)
+admn1_by_state_fips = index_features(admn1_shp, get_state_fips_key)
+usa_admn2_by_fips = index_features(usa_admn2_shp, get_admn2_key)
+usa_metro_by_cbsa = index_features(usa_metro_shp, get_metro_key)
 
 us_state_feats = []
 for fips in nyt_state["fips"].unique():
-    feats = next((i for i in usa_admn1_shp if (i["properties"]["fips"] != None and i["properties"]["fips"][2:] == fips) or (i["properties"]["adm0_a3"] != "USA" and fips_iso3[i["properties"]["adm0_a3"]] == fips)), None)
+    feats = admn1_by_state_fips.get(fips)
     if feats == None:
         print("NYT Data doesn't have matching for state with fips {}".format(fips))
-        assert False, "FIPS for NYT data missing. Please add iso3 code to fips_iso3 dict on line 205"
+        assert False, "FIPS for NYT data missing. Please add iso3 code to fips_iso3 dict in data_aggregator/geometry.py"
     us_state_feats.append([fips, feats])
 
 us_state_feats = dict(us_state_feats)
 
-def get_us_admn2_feat(fips, shp):
-    feats = next((i for i in shp if str(i["properties"]["STATEFP"]) + str(i["properties"]["COUNTYF"]) == fips), None)
+def get_us_admn2_feat(fips, index):
+    feats = index.get(fips)
     if feats == None:
         print("NYT Data doesn't have matching for county with fips {}".format(fips))
     return feats
 
 county_fips_list = nyt_county["fips"].dropna().unique().tolist()
-with multiprocessing.Pool(processes = nprocess) as pool:
-    usa_admn2_feats = pool.starmap(get_us_admn2_feat, zip(county_fips_list, repeat(list(usa_admn2_shp))))
-    pool.close()
-    pool.join()
-
-usa_admn2_feats = dict(zip(county_fips_list, usa_admn2_feats))
+usa_admn2_feats = dict([[i, get_us_admn2_feat(i, usa_admn2_by_fips)] for i in county_fips_list])
 
 # Add lat long from extracted features
 # For NYC and KC add admin_level = 1.7 and a new FIPS code called
@@ -351,20 +339,14 @@ metro["fips"] = metro["FIPS State Code"] + metro["FIPS County Code"].apply(lambd
 daily_df = pd.merge(daily_df, metro, on = "fips", how="left")
 
 # Extract metropolitan area features
-def get_metro_feat(cbsa, shp):
-    feats = next((i for i in shp if i["properties"]["CBSAFP"] == cbsa), None)
+def get_metro_feat(cbsa, index):
+    feats = index.get(cbsa)
     if feats == None:
         print("Couldn't find metro feature for CBSA code: {}".format(cbsa))
     return feats
 
-metro_feats = []
 metro_list = daily_df["CBSA Code"].dropna().unique()
-with multiprocessing.Pool(processes = nprocess) as pool:
-    metro_feats = pool.starmap(get_metro_feat, zip(metro_list, repeat(list(usa_metro_shp))))
-    pool.close()
-    pool.join()
-
-metro_feats = dict(zip(metro_list, metro_feats))
+metro_feats = dict([[i, get_metro_feat(i, usa_metro_by_cbsa)] for i in metro_list])
 
 # Add testing data
 def get_us_testing_data(admn1_shp):
@@ -411,17 +393,16 @@ country_feats = {}
 
 print("Computing geo joins ... ")
 
-with multiprocessing.Pool(processes = nprocess) as pool:
-    # Country
-    lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"].groupby(["Lat", "Long"])]
-    feats = pool.starmap(get_closest_polygon, zip(lat_lng, repeat(list(admn0_shp))))
-    country_feats = dict(zip(lat_lng, feats))
-    # State
-    lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"][~daily_df["Province_State"].isna()].groupby(["Lat", "Long"])]
-    feats = pool.starmap(get_closest_polygon, zip(lat_lng, repeat(list(admn1_shp))))
-    state_feats = dict(zip(lat_lng, feats))
-    pool.close()
-    pool.join()
+# Country
+admn0_feats = list(admn0_shp)
+admn0_index = SpatialIndex(GeometryStore(admn0_shp))
+lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"].groupby(["Lat", "Long"])]
+country_feats = dict([[i, admn0_feats[admn0_index.get_closest_polygon(i)]] for i in lat_lng])
+# State
+admn1_feats = list(admn1_shp)
+admn1_index = SpatialIndex(GeometryStore(admn1_shp))
+lat_lng = [i[0] for i in daily_df[daily_df["Country_Region"]!="USA_NYT"][~daily_df["Province_State"].isna()].groupby(["Lat", "Long"])]
+state_feats = dict([[i, admn1_feats[admn1_index.get_closest_polygon(i)]] for i in lat_lng])
 
 print("Completed geo joins.")
 
@@ -438,7 +419,7 @@ cruises_capacity = {
     "Grand Princess": 3533
 }
 
-usa_country_feat = next(i for i in admn0_shp if i["properties"]["ADM0_A3"]=="USA")
+usa_country_feat = admn0_by_iso3["USA"]
 
 daily_df.columns = daily_df.columns.str.replace(" ", "_").str.replace("/", "")
 
@@ -588,7 +569,7 @@ centroid = get_centroid(metro_feat["geometry"])
 daily_df.loc[nyc_df.index, "computed_metro_long"] = centroid[0]
 daily_df.loc[nyc_df.index, "computed_metro_lat"] = centroid[1]
 # Add state for city_df records
-ny_state_feature = next(i for i in admn1_shp if i["properties"]["i_3166_"] == "US-NY")
+ny_state_feature = admn1_by_iso3["US-NY"]
 centroid = get_centroid(ny_state_feature["geometry"])
 daily_df.loc[nyc_df.index, "computed_state_long"] = centroid[0]
 daily_df.loc[nyc_df.index, "computed_state_lat"] = centroid[1]
@@ -608,7 +589,7 @@ centroid = get_centroid(metro_feat["geometry"])
 daily_df.loc[kc_df.index, "computed_metro_long"] = centroid[0]
 daily_df.loc[kc_df.index, "computed_metro_lat"] = centroid[1]
 # Add state for city_df records
-mo_state_feature = next(i for i in admn1_shp if i["properties"]["i_3166_"] == "US-MO")
+mo_state_feature = admn1_by_iso3["US-MO"]
 centroid = get_centroid(mo_state_feature["geometry"])
 daily_df.loc[kc_df.index, "computed_state_long"] = centroid[0]
 daily_df.loc[kc_df.index, "computed_state_lat"] = centroid[1]
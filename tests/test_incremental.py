@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+from data_aggregator.rollup import Rollup
+from data_aggregator.cube import build_count_cube
+from data_aggregator.stats import compute_stats, compute_level_stats, generate_level_items
+from data_aggregator.incremental import get_level_items, update_level_items, load_item_state, get_item_state_path, is_same_item
+
+count_columns = ["Confirmed", "Recovered", "Deaths"]
+
+def generate_test_item(ind, stats, testing, locations):
+    item = {
+        "_id": ind[0] + "_" + ind[1].strftime("%Y-%m-%d"),
+        "date": ind[1].strftime("%Y-%m-%d"),
+        "name": locations.loc[ind[0], "name"],
+        "population": locations.loc[ind[0], "pop"]
+    }
+    if ind in testing.index:
+        item["tests"] = testing.loc[ind, "tests"]
+    compute_stats(item, stats)
+    return item
+
+# Daily counts of locations from days, {key: days}, with counts drawn from seed
+def get_daily_df(days, seed = 0):
+    rng = np.random.RandomState(seed)
+    frames = []
+    for key, key_days in sorted(days.items()):
+        confirmed = np.cumsum(rng.randint(0, 40, len(key_days))).astype(float)
+        deaths = np.cumsum(rng.randint(0, 4, len(key_days))).astype(float)
+        frames.append(pd.DataFrame({
+            "key": key,
+            "date": pd.Timestamp("2020-03-01") + pd.to_timedelta(list(key_days), unit = "D"),
+            "Confirmed": confirmed,
+            "Recovered": np.nan,
+            "Deaths": deaths
+        }))
+    return pd.concat(frames, ignore_index = True)
+
+# Counts of two runs. The second adds days to most locations, revises counts within and before the days kept by the state,
+# has a location with no new days, one reporting again after a gap, one falling back below a daysSince threshold and a new location
+def get_runs():
+    days = dict([[key, range(43)] for key in "AC"] + [[key, range(42)] for key in "BH"] + [["D", range(31)], ["E", list(range(26)) + [41]], ["F", range(40)], ["G", range(41)]])
+    second = get_daily_df(days)
+    first = second[second["date"] < pd.Timestamp("2020-04-10")].reset_index(drop = True)
+    second.loc[(second["key"] == "B") & (second["date"] == pd.Timestamp("2020-03-31")), "Confirmed"] += 7
+    second.loc[(second["key"] == "C") & (second["date"] == pd.Timestamp("2020-03-06")), "Confirmed"] += 3
+    second.loc[(second["key"] == "G") & (second["date"] == pd.Timestamp("2020-04-10")), "Deaths"] = 1
+    return first, pd.concat([second, get_daily_df({"I": range(35, 43)}, seed = 1)], ignore_index = True)
+
+def get_cube(daily_df):
+    return build_count_cube(Rollup(daily_df, ["key"], count_columns), {"loc": "key"})
+
+def get_context(daily_df, revised = False):
+    keys = sorted(daily_df["key"].unique())
+    locations = pd.DataFrame({"name": ["Location " + i for i in keys], "pop": [1000. * (n + 1) for n in range(len(keys))]}, index = keys)
+    testing = daily_df[daily_df["key"].isin(["A", "D", "H"])].set_index(["key", "date"])[["Confirmed"]].rename(columns = {"Confirmed": "tests"}) * 3
+    if revised:
+        locations.loc["F", "pop"] = 1.
+        testing.loc[("H", pd.Timestamp("2020-03-20")), "tests"] += 1
+    return {"testing": testing, "locations": locations}
+
+def test_incremental_items_match_full_generation(tmp_path):
+    first, second = get_runs()
+    state_path = get_item_state_path(str(tmp_path), "loc")
+    # First run has no state, so every item is generated and the state is saved
+    get_level_items(generate_test_item, get_cube(first), "loc", get_context(first), 1, "loc", 2, state_path, "incremental", row_context = ["testing"], location_context = ["locations"])
+    state = load_item_state(state_path)
+    state_items = set(id(item) for location in state["locations"].values() for item in location["items"])
+    cube = get_cube(second)
+    context = get_context(second, revised = True)
+    items = update_level_items(generate_test_item, cube, "loc", context, 1, "loc", 2, state, row_context = ["testing"], location_context = ["locations"])
+    full_items = generate_level_items(generate_test_item, compute_level_stats(cube, "loc"), context, 1, "loc", 2)
+    assert len(items) == len(full_items)
+    for item, full_item in zip(items, full_items):
+        assert is_same_item(item, full_item), (full_item["_id"], item, full_item)
+    # Items of A before the 3 days ahead of its new days and every item of D, without new days, are carried forward.
+    # Every item of C, revised before the days kept by the state, and of G, whose daysSince crossing moved, is generated again
+    carried = dict([[item["_id"], id(item) in state_items] for item in items])
+    assert [carried["A_" + i.strftime("%Y-%m-%d")] for i in pd.date_range("2020-03-01", "2020-04-12")] == [True] * 37 + [False] * 6
+    assert all(v for k, v in carried.items() if k.startswith("D_"))
+    assert not any(v for k, v in carried.items() if k.startswith("C_") or k.startswith("G_"))
@@ -0,0 +1,34 @@
+import os
+import json
+import numpy as np
+from data_aggregator.geometry import GeometryStore, get_closest_polygon
+from data_aggregator.spatial_index import SpatialIndex
+from data_aggregator.raster_grid import RasterGrid, build_raster_grid
+
+countries_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "geo", "countries.json")
+
+def get_store():
+    with open(countries_path) as f:
+        return GeometryStore(json.load(f)["features"], lambda x: x["location_id"])
+
+# Seeded points over land and sea. Points in the sea have no containing feature and use the nearest polygon fallback
+def get_points(n = 300, seed = 0):
+    rng = np.random.RandomState(seed)
+    return list(zip(rng.uniform(-60, 80, n), rng.uniform(-180, 180, n)))
+
+def test_spatial_index_matches_linear_scan():
+    store = get_store()
+    index = SpatialIndex(store)
+    points = get_points()
+    fallback = [i for i in points if index.get_containing(*i) is None]
+    assert len(fallback) > 0 and len(fallback) < len(points)
+    for coords in points:
+        assert index.get_closest_polygon(coords) == get_closest_polygon(coords, store), coords
+
+def test_raster_grid_matches_linear_scan():
+    store = get_store()
+    grid = RasterGrid(build_raster_grid(store, 1.0), 1.0, SpatialIndex(store))
+    points = get_points(seed = 1)
+    assert any(grid.get_cell(*i) >= 0 for i in points)
+    for coords in points:
+        assert grid.get_closest_polygon(coords) == get_closest_polygon(coords, store), coords
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from data_aggregator.stats import (compute_series_stats, compute_stats, compute_doubling_rate, compute_doubling_rates, compute_days_since,
+                                   get_days_since_thresholds)
+
+# Stats of one item computed from the series of its location per date, as compute_stats did before stats were computed per series
+def compute_baseline_stats(item, grouped_sum, key, current_date):
+    keys = ["Confirmed", "Recovered", "Deaths"]
+    api_keys = ["confirmed", "recovered", "dead"]
+    first_date = {}
+    sorted_group_sum = grouped_sum.loc[key]["Confirmed"].sort_index()
+    item["mostRecent"] = (current_date == sorted_group_sum.index[-1])
+    for stat_key, api_key in zip(keys, api_keys):
+        sorted_group_sum = grouped_sum.loc[key][stat_key].sort_index()
+        compute_num_increase = lambda x: sorted_group_sum[x] - sorted_group_sum[x - timedelta(days = 1)] if x - timedelta(days = 1) in sorted_group_sum.index else sorted_group_sum[x]
+        item[api_key] = sorted_group_sum[current_date]
+        tmp_grp = sorted_group_sum.reset_index()
+        rolling_average = tmp_grp[(tmp_grp["date"] <= current_date + timedelta(days = 3)) & (tmp_grp["date"] >= current_date - timedelta(days = 3))]["date"].apply(compute_num_increase)
+        rolling_average = rolling_average[rolling_average >= 0].mean()
+        if not np.isnan(rolling_average):
+            item[api_key + "_rolling"] = rolling_average
+        rolling_average_14days_ago = tmp_grp[(tmp_grp["date"] <= current_date - timedelta(days = 11)) & (tmp_grp["date"] >= current_date - timedelta(days = 17))]["date"].apply(compute_num_increase)
+        rolling_average_14days_ago = rolling_average_14days_ago[rolling_average_14days_ago >= 0].mean() if rolling_average_14days_ago.shape[0] > 0 else np.nan
+        if not np.isnan(rolling_average_14days_ago):
+            item[api_key + "_rolling_14days_ago"] = rolling_average_14days_ago
+            if api_key + "_rolling" in item:
+                item[api_key + "_rolling_14days_ago_diff"] = rolling_average - rolling_average_14days_ago
+        val_dr = [i for i in tmp_grp[(tmp_grp["date"] <= current_date) & (tmp_grp["date"] >= current_date - timedelta(days = 4))][stat_key].tolist() if i > 0]
+        dr = compute_doubling_rate(val_dr) if len(val_dr) > 1 else np.nan
+        if not np.isnan(dr):
+            item[api_key + "_doublingRate"] = dr
+        first_date[stat_key] = sorted_group_sum[sorted_group_sum > 0].index[0] if sorted_group_sum[sorted_group_sum > 0].shape[0] > 0 else ""
+        item[api_key + "_firstDate"] = first_date[stat_key].strftime("%Y-%m-%d") if first_date[stat_key] != "" else ""
+        item[api_key + "_newToday"] = True if len(sorted_group_sum) > 1 and sorted_group_sum.iloc[-1] - sorted_group_sum.iloc[-2] > 0 else False
+        item[api_key + "_numIncrease"] = compute_num_increase(current_date)
+        if current_date - timedelta(days = 1) in sorted_group_sum.index and sorted_group_sum[current_date - timedelta(days = 1)] > 0:
+            item[api_key + "_pctIncrease"] = (sorted_group_sum[current_date] - sorted_group_sum[current_date - timedelta(days = 1)]) / sorted_group_sum[current_date - timedelta(days = 1)]
+        if "population" in item and item["population"] > 0:
+            for per_capita_key in [api_key, api_key + "_rolling", api_key + "_rolling_14days_ago", api_key + "_rolling_14days_ago_diff"]:
+                if per_capita_key in item:
+                    item[per_capita_key + "_per_100k"] = (item[per_capita_key] / item["population"]) * 100000
+    if first_date["Confirmed"] != "" and first_date["Deaths"] != "":
+        item["first_dead-first_confirmed"] = (first_date["Deaths"] - first_date["Confirmed"]).days
+    for name, stat_key, ncases in [["daysSince100Cases", "Confirmed", 100], ["daysSince10Deaths", "Deaths", 10], ["daysSince50Deaths", "Deaths", 50]]:
+        days_since = compute_days_since(grouped_sum.loc[key][stat_key].sort_index(), ncases, current_date)
+        if days_since != None and days_since >= 0:
+            item[name] = days_since
+
+# Cumulative counts of locations with days missing from their series, counts that are corrected down, no deaths and no recovered
+def get_grouped_sum(seed = 0):
+    rng = np.random.RandomState(seed)
+    rows = []
+    for loc in range(8):
+        dates = pd.date_range("2020-01-22", periods = rng.randint(1, 60))
+        if loc % 3:
+            dates = dates[rng.rand(len(dates)) > 0.15]
+        confirmed = 0.
+        deaths = 0.
+        recovered = 0.
+        for date in dates:
+            confirmed = max(0., confirmed + rng.randint(-5, 40) * (loc + 1))
+            deaths = max(0., deaths + rng.randint(-1, 4))
+            recovered += rng.randint(0, 3)
+            rows.append(["L{}".format(loc), date, confirmed, deaths if loc != 4 else 0., recovered if loc % 2 else np.nan])
+    df = pd.DataFrame(rows, columns = ["key", "date", "Confirmed", "Deaths", "Recovered"])
+    return df.groupby(["key", "date"])[["Confirmed", "Recovered", "Deaths"]].sum()
+
+def is_close(a, b):
+    return a == b or (isinstance(a, (float, np.floating)) and abs(a - b) <= 1e-9 * max(1., abs(a)))
+
+def test_series_stats_match_baseline():
+    grouped_sum = get_grouped_sum()
+    series_stats = compute_series_stats(grouped_sum)
+    assert list(series_stats.index) == list(grouped_sum.index)
+    for n, (key, current_date) in enumerate(grouped_sum.index):
+        expected = {"population": 1000.} if n % 2 else {}
+        item = dict(expected)
+        compute_baseline_stats(expected, grouped_sum, key, current_date)
+        compute_stats(item, series_stats.loc[(key, current_date)])
+        assert list(item.keys()) == list(expected.keys()), (key, current_date)
+        for k in expected:
+            assert is_close(expected[k], item[k]), (key, current_date, k, expected[k], item[k])
+
+# Series with growth, flat runs, zero counts and days without data (NaN)
+def get_doubling_series(seed = 0):
+    rng = np.random.RandomState(seed)
+    series = [
+        np.cumsum(rng.randint(0, 50, 40)).astype(float),
+        np.full(20, 7.),
+        np.zeros(20),
+        np.array([0., 0., 1., 1., 1., 2., 0., 4., 4., 8., 16., 16., 16., 16., 16.]),
+        np.array([5., np.nan, 10., np.nan, np.nan, 40., 80., np.nan, 80., 80., 0., 160.])
+    ]
+    series.append(np.where(rng.rand(40) > 0.2, np.cumsum(rng.randint(-3, 10, 40)), np.nan).astype(float))
+    return series
+
+# Doubling rate of the positive values of the 5 days ending at every day, NaN where there are fewer than 2
+def get_baseline_doubling_rates(values):
+    res = []
+    for n in range(len(values)):
+        window = [i for i in values[max(n - 4, 0):n + 1] if i > 0]
+        res.append(compute_doubling_rate(window) if len(window) > 1 else np.nan)
+    return np.array(res)
+
+def test_doubling_rates_match_polyfit():
+    series = get_doubling_series()
+    for values in series:
+        np.testing.assert_allclose(compute_doubling_rates(values), get_baseline_doubling_rates(values), rtol = 1e-9)
+    # Locations x days gives the same rates as each location on its own
+    values = np.array([i[:12] for i in series])
+    np.testing.assert_allclose(compute_doubling_rates(values), np.array([get_baseline_doubling_rates(i) for i in values]), rtol = 1e-9)
+
+# Confirmed and deaths of locations that cross thresholds, stay flat, stay at zero, never cross, start above a threshold
+# or fall back below it, with days missing from some series
+def get_days_since_grouped_sum(seed = 0):
+    rng = np.random.RandomState(seed)
+    series = {
+        "growing": np.cumsum(rng.randint(0, 30, 30)).astype(float),
+        "flat": np.full(15, 60.),
+        "zero": np.zeros(15),
+        "below": np.minimum(np.arange(20, dtype = float), 9.),
+        "above": np.arange(200., 230.),
+        "exact": np.array([0., 5., 10., 10., 50., 100., 100., 150.]),
+        "corrected": np.array([0., 20., 120., 80., 90., 110., 40., 130., 160.]),
+        "random": np.cumsum(rng.randint(-10, 25, 40)).astype(float)
+    }
+    frames = []
+    for key, values in series.items():
+        dates = pd.date_range("2020-03-01", periods = values.shape[0])
+        keep = rng.rand(values.shape[0]) > 0.2 if key in ["growing", "random"] else np.ones(values.shape[0], dtype = bool)
+        frames.append(pd.DataFrame({"key": key, "date": dates[keep], "Confirmed": values[keep], "Recovered": 0., "Deaths": values[keep] / 4}))
+    return pd.concat(frames).groupby(["key", "date"])[["Confirmed", "Recovered", "Deaths"]].sum()
+
+def test_days_since_match_baseline():
+    grouped_sum = get_days_since_grouped_sum()
+    thresholds = get_days_since_thresholds(cases = [1, 10, 100, 1000], deaths = [0, 10, 50])
+    series_stats = compute_series_stats(grouped_sum, thresholds)
+    for name, stat_key, ncases in thresholds:
+        for key, current_date in grouped_sum.index:
+            expected = compute_days_since(grouped_sum.loc[key][stat_key].sort_index(), ncases, current_date)
+            days_since = series_stats.loc[(key, current_date), name]
+            if expected == None:
+                assert np.isnan(days_since), (name, key, current_date, days_since)
+            else:
+                assert abs(days_since - expected) <= 1e-9, (name, key, current_date, expected, days_since)